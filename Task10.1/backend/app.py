@@ -1,6 +1,9 @@
-﻿import os
-import re
-from flask import Flask, request, render_template, Response
+﻿import click
+import json
+import logging
+import os
+import requests
+from flask import Flask, request, render_template, Response, stream_with_context
 from flask_restful import Resource, Api
 from flask_pymongo import PyMongo
 from flask_bcrypt import Bcrypt
@@ -9,8 +12,21 @@ from flask_jwt_extended import JWTManager, jwt_required, create_access_token, ge
 from gradientai import Gradient
 from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed, wait
+from parsing import parse_quiz
+from passwords import HasherBusy, PasswordHasher, tune_rounds
+import hashlib
+import itertools
+import queue
 import random
+import threading
+import time
 
 # Load environment variables
 load_dotenv()
@@ -19,38 +35,287 @@ load_dotenv()
 app = Flask(__name__)
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")
+# bcrypt cost of password hashes, tuned at startup to take about BCRYPT_TARGET_MS milliseconds per hash (but at least
+# 12) unless set. Stored hashes made at a lower cost are rehashed when their user next logs in
+app.config["BCRYPT_TARGET_MS"] = float(os.getenv("BCRYPT_TARGET_MS", 250))
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS") or tune_rounds(app.config["BCRYPT_TARGET_MS"]))
+# Threads hashing passwords, and how many more hashes can wait for one before sign ins are refused with 503
+app.config["PASSWORD_WORKERS"] = int(os.getenv("PASSWORD_WORKERS", 2))
+app.config["PASSWORD_QUEUE"] = int(os.getenv("PASSWORD_QUEUE", 16))
+# Number of worker threads used to generate quizzes, and the maximum number of concurrent calls to the model
+app.config["QUIZ_WORKERS"] = int(os.getenv("QUIZ_WORKERS", 8))
+app.config["QUIZ_MAX_CONCURRENCY"] = int(os.getenv("QUIZ_MAX_CONCURRENCY", 4))
+# Model quizzes and explanations are generated with: "gradient" (the Gradient API), "local" (llama.cpp servers) or
+# "fake" (deterministic output after a fixed latency in seconds, to develop and benchmark without a model)
+app.config["QUIZ_MODEL"] = os.getenv("QUIZ_MODEL", "gradient")
+app.config["QUIZ_FAKE_LATENCY"] = float(os.getenv("QUIZ_FAKE_LATENCY", 0))
+# Comma separated base URLs of the llama.cpp servers for the local model, which are used in turn, the timeout for a
+# single request in seconds, and whether quizzes are constrained by QUIZ_GRAMMAR so they always match the format
+app.config["LLAMA_ENDPOINTS"] = os.getenv("LLAMA_ENDPOINTS", "http://localhost:8080").split(",")
+app.config["LLAMA_TIMEOUT"] = float(os.getenv("LLAMA_TIMEOUT", 120))
+app.config["LLAMA_USE_GRAMMAR"] = os.getenv("LLAMA_USE_GRAMMAR", "true").lower() == "true"
+# Quizzes are replenished as users complete them, so the full sweep only needs to run occasionally as a fallback
+app.config["QUIZ_SWEEP_MINUTES"] = int(os.getenv("QUIZ_SWEEP_MINUTES", 15))
+# Number of available quizzes to keep in stock for each topic, and how many users each stocked quiz can be given to
+app.config["QUIZ_STOCK_DEPTH"] = int(os.getenv("QUIZ_STOCK_DEPTH", 10))
+app.config["QUIZ_STOCK_MAX_USES"] = int(os.getenv("QUIZ_STOCK_MAX_USES", 50))
+# Largest page of quizzes that can be requested with the 'limit' parameter
+app.config["QUIZ_PAGE_MAX_LIMIT"] = int(os.getenv("QUIZ_PAGE_MAX_LIMIT", 100))
+# Number of explanations kept in memory in front of the reasoning collection, and threads used to generate them
+app.config["REASONING_CACHE_SIZE"] = int(os.getenv("REASONING_CACHE_SIZE", 1024))
+app.config["REASONING_WORKERS"] = int(os.getenv("REASONING_WORKERS", 4))
+# Seconds the history endpoint waits for explanations that are not cached, before returning them as pending
+app.config["HISTORY_REASONING_DEADLINE"] = float(os.getenv("HISTORY_REASONING_DEADLINE", 10))
+# Seconds a rendered shared profile is cached for, how many are cached, and an optional directory to write rendered
+# profiles to so a front proxy can serve them directly
+app.config["SHARED_PROFILE_TTL"] = int(os.getenv("SHARED_PROFILE_TTL", 300))
+app.config["SHARED_PROFILE_CACHE_SIZE"] = int(os.getenv("SHARED_PROFILE_CACHE_SIZE", 1024))
+app.config["SHARED_PROFILE_SNAPSHOT_DIR"] = os.getenv("SHARED_PROFILE_SNAPSHOT_DIR")
+
+# Log generation throughput and other background activity
+app.logger.setLevel(logging.INFO)
 
 # Initialize Flask extensions
 mongo = PyMongo(app)
 bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 api = Api(app)
+password_hasher = PasswordHasher(bcrypt, app.config["BCRYPT_LOG_ROUNDS"], app.config["PASSWORD_WORKERS"],
+                                 app.config["PASSWORD_QUEUE"])
+
+# Topics users can choose as interests
+INTERESTS = [
+    "Programming Languages",
+    "Algorithms",
+    "Software Engineering",
+    "Game Development",
+    "Computer Networks",
+    "Data Science",
+    "Operating Systems",
+    "Mobile Development",
+    "Database Systems",
+    "Cloud Computing",
+    "Machine Learning",
+    "Cybersecurity",
+    "Artificial Intelligence",
+    "Data Structures",
+    "Computer Graphics",
+    "Web Development",
+    "Testing",
+    "Embedded Systems"
+]
+
+# Indexes for every query the app makes, created at startup
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("interests", ASCENDING)])
+    ],
+    "quizzes": [
+        IndexModel([("user_id", ASCENDING), ("complete", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)])
+    ],
+    "quiz_stock": [
+        IndexModel([("topic", ASCENDING), ("uses", ASCENDING)]),
+        IndexModel([("uses", ASCENDING)])
+    ]
+}
+
+# GBNF grammar for the quiz format, three questions each with four options and the correct answer. Used to constrain
+# generation on backends that support grammars (Gradient's completion API does not)
+QUIZ_GRAMMAR = r'''
+root     ::= question question question
+question ::= "QUESTION: " line "\n" "OPTION A: " line "\n" "OPTION B: " line "\n" "OPTION C: " line "\n" "OPTION D: " line "\n" "ANS: " [ABCD] "\n"
+line     ::= [^\n]+
+'''
+
+# Maps answer letters to the index of the option
+ANSWER_TO_INDEX = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
+
+
+class Metrics:
+    """
+    Thread safe counters, reported by the metrics endpoint
+    """
 
+    def __init__(self):
+        """ Initialize Metrics """
+        self.counters = Counter()
+        self.lock = threading.Lock()
 
-class QuizManager:
+    def increment(self, name, amount=1):
+        """ Increment a counter """
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        """ Get the current value of every counter """
+        with self.lock:
+            return dict(self.counters)
+
+
+class ReasoningCache:
     """
-    QuizManager class to manage quiz generation and storage
+    Two tier cache of explanations for incorrect answers, an in-memory LRU in front of a MongoDB collection
     """
 
-    model_adapter = None
+    def __init__(self, size):
+        """ Initialize ReasoningCache """
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-    def __init__(self):
-        """ Initialize QuizManager """
-        # Initialize Gradient API
-        gradient = Gradient()
-        base_model = gradient.get_base_model(base_model_slug="llama2-7b-chat")
-        name = f"Llama_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        self.model_adapter = base_model.create_model_adapter(name=name)
+    @staticmethod
+    def make_key(question, correct_answer, incorrect_answer):
+        """ Hash the question and answers into a cache key """
+        text = "\x00".join((question, correct_answer, incorrect_answer))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """ Get the reasoning for a key, or None if it has not been generated """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        document = mongo.db.reasonings.find_one({'_id': key}, {'reasoning': 1})
+        if document is None:
+            return None
+        self.remember(key, document['reasoning'])
+        return document['reasoning']
+
+    def put(self, key, reasoning):
+        """ Store the reasoning for a key """
+        mongo.db.reasonings.update_one({'_id': key}, {'$setOnInsert': {'reasoning': reasoning, 'created': datetime.utcnow()}},
+                                       upsert=True)
+        self.remember(key, reasoning)
+
+    def remember(self, key, reasoning):
+        """ Add the reasoning to the in-memory cache, evicting the least recently used entry if full """
+        with self.lock:
+            self.entries[key] = reasoning
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class ProfileCache:
+    """
+    LRU cache of rendered shared profile pages, optionally written through to disk
+    """
 
-        # Initialize scheduler to generate quizzes
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(self.generate_quizzes, 'interval', minutes=1)
-        scheduler.start()
+    def __init__(self, ttl, size, snapshot_dir=None):
+        """ Initialize ProfileCache """
+        self.ttl = ttl
+        self.size = size
+        self.snapshot_dir = snapshot_dir
+        self.entries = OrderedDict()
+        # When each user's page was last invalidated, so pages rendered before then aren't cached. Only kept for ttl
+        # seconds, as pages that took longer than that to render are never cached anyway
+        self.invalidated = OrderedDict()
+        self.lock = threading.Lock()
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            # Pages left by a previous process are no longer tracked, so would never be expired or invalidated
+            for name in os.listdir(snapshot_dir):
+                if name.endswith((".html", ".html.tmp")):
+                    try:
+                        os.remove(os.path.join(snapshot_dir, name))
+                    except FileNotFoundError:
+                        pass
+
+    def get(self, user_id):
+        """ Get the cached page for a user, or None if it is missing or has expired """
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            if entry['expires'] < time.monotonic():
+                del self.entries[user_id]
+                self.remove_snapshot(user_id)
+                return None
+            self.entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user_id, html, started):
+        """
+        Cache the page for a user, rendered from data read at time.monotonic() value started. It is returned but not
+        cached if the user's page was invalidated after the data was read
+        """
+        entry = {'html': html, 'etag': hashlib.sha1(html.encode('utf-8')).hexdigest(),
+                 'last_modified': datetime.utcnow().replace(microsecond=0), 'expires': started + self.ttl}
+        with self.lock:
+            now = time.monotonic()
+            if entry['expires'] < now or self.invalidated.get(user_id, float("-inf")) >= started:
+                return entry
+            self.entries[user_id] = entry
+            self.entries.move_to_end(user_id)
+            if self.snapshot_dir:
+                # Write to a temporary file first so the proxy never serves a partially written page. Dated when the
+                # data was read, so the proxy can tell how old it is
+                path = self.snapshot_path(user_id)
+                with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                    f.write(html)
+                wall_clock_started = time.time() - (now - started)
+                os.utime(f"{path}.tmp", (wall_clock_started, wall_clock_started))
+                os.replace(f"{path}.tmp", path)
+            self.prune(now)
+        return entry
+
+    def invalidate(self, user_id):
+        """ Remove the cached page for a user, after their profile or stats change """
+        with self.lock:
+            now = time.monotonic()
+            self.invalidated[user_id] = now
+            self.invalidated.move_to_end(user_id)
+            while next(iter(self.invalidated.values())) < now - self.ttl:
+                self.invalidated.popitem(last=False)
+            if self.entries.pop(user_id, None) is not None:
+                self.remove_snapshot(user_id)
+
+    def prune(self, now):
+        """ Remove expired pages and, while over the size limit, the least recently used, with their snapshots """
+        for user_id in [user_id for user_id, entry in self.entries.items() if entry['expires'] < now]:
+            del self.entries[user_id]
+            self.remove_snapshot(user_id)
+        while len(self.entries) > self.size:
+            user_id, _ = self.entries.popitem(last=False)
+            self.remove_snapshot(user_id)
+
+    def remove_snapshot(self, user_id):
+        """ Remove the snapshot of a user's page, if snapshots are written """
+        if self.snapshot_dir:
+            try:
+                os.remove(self.snapshot_path(user_id))
+            except FileNotFoundError:
+                pass
+
+    def snapshot_path(self, user_id):
+        """ Path of the snapshot of a user's page """
+        return os.path.join(self.snapshot_dir, f"{user_id}.html")
+
+
+class AbstractQuizModel(ABC):
+    """
+    Abstract class for the model quizzes and explanations of incorrect answers are generated with
+    """
+    # Name of the model, as set in the QUIZ_MODEL config
+    name = None
+
+    @abstractmethod
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic """
+        pass
+
+    @abstractmethod
+    def generate_reasoning(self, question, correct_answer, incorrect_answer):
+        """ Generate an explanation of why the incorrect answer is wrong """
+        pass
 
     @staticmethod
-    def fetch_quiz_from_llama(student_topic, model_adapter):
-        """ Fetch quiz from Llama model """
-        query = (
+    def quiz_query(student_topic):
+        """ Prompt for a quiz on a topic """
+        return (
             f"[INST] Generate a quiz with 3 questions to test students on the provided topic. "
             f"For each question, generate 4 options where only one of the options is correct. "
             f"Format your response as follows:\n"
@@ -65,56 +330,11 @@ class QuizManager:
             f"Here is the student topic:\n{student_topic}"
             f"[/INST]"
         )
-        response = model_adapter.complete(query=query, max_generated_token_count=500).generated_output
-        return response
-
-    @staticmethod
-    def process_quiz(quiz_text):
-        """ Process quiz text and return quiz data """
-        questions = []
-        pattern = re.compile(
-            r'QUESTION: (.+?)\n(?:OPTION A: (.+?)\n)+(?:OPTION B: (.+?)\n)+(?:OPTION C: (.+?)\n)+(?:OPTION D: (.+?)\n)+ANS: (.+?)',
-            re.DOTALL)
-        matches = pattern.findall(quiz_text)
-
-        for match in matches:
-            question = match[0].strip()
-            options = match[1].strip(), match[2].strip(), match[3].strip(), match[4].strip()
-            correct_ans = match[-1].strip()
-
-            question_data = {
-                "question": question,
-                "options": options,
-                "correct_answer": correct_ans
-            }
-            questions.append(question_data)
-
-        return questions
 
     @staticmethod
-    def store_quiz(topic, questions, user_id):
-        """ Store quiz in MongoDB """
-        quiz = {'user_id': user_id, 'complete': False, 'selected_answers': [], 'topic': topic, 'questions': questions, 'score': 0}
-        mongo.db.quizzes.insert_one(quiz)
-
-    def generate_quizzes(self):
-        """ Generate quizzes for users """
-        users = mongo.db.users.find()
-        for user in users:
-            # Skip users with no interests
-            if not user['interests']:
-                continue
-            incomplete_quizzes = mongo.db.quizzes.count_documents({"user_id": user['_id'], "complete": False})
-            while incomplete_quizzes < 3:
-                # Generate quiz for random interest
-                topic = random.choice(user['interests'])
-                quiz = self.process_quiz(self.fetch_quiz_from_llama(topic, self.model_adapter))
-                self.store_quiz(topic, quiz, user['_id'])
-                incomplete_quizzes += 1
-
-    def get_reasoning(self, question, correct_answer, incorrect_answer):
-        """ Get reasoning for incorrect answers """
-        query = (
+    def reasoning_query(question, correct_answer, incorrect_answer):
+        """ Prompt for an explanation of an incorrect answer """
+        return (
             f"[INST] The student was asked a question and provided the wrong answer. "
             f"Can you explain in a single short sentence why their selected answer was wrong and why the correct answer is correct. "
             f"Format your response as a simple sentence, without greetings or any other text. "
@@ -124,8 +344,408 @@ class QuizManager:
             f"INCORRECT ANSWER: {incorrect_answer}\n"
             f"[/INST]"
         )
-        response = self.model_adapter.complete(query=query, max_generated_token_count=500).generated_output
-        return response
+
+
+class GradientQuizModel(AbstractQuizModel):
+    """
+    Class to generate quizzes using Gradient API
+    """
+    name = "gradient"
+    model_adapter = None
+
+    def __init__(self):
+        """ Initialize GradientQuizModel """
+        gradient = Gradient()
+        base_model = gradient.get_base_model(base_model_slug="llama2-7b-chat")
+        name = f"Llama_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.model_adapter = base_model.create_model_adapter(name=name)
+
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic, Gradient's completion API can't be constrained by a grammar """
+        query = self.quiz_query(topic)
+        return self.model_adapter.complete(query=query, max_generated_token_count=500).generated_output
+
+    def generate_reasoning(self, question, correct_answer, incorrect_answer):
+        """ Generate an explanation of why the incorrect answer is wrong """
+        query = self.reasoning_query(question, correct_answer, incorrect_answer)
+        return self.model_adapter.complete(query=query, max_generated_token_count=500).generated_output
+
+
+class LocalQuizModel(AbstractQuizModel):
+    """
+    Class to generate quizzes using llama.cpp servers
+    """
+    name = "local"
+
+    def __init__(self, endpoints, timeout, use_grammar):
+        """ Initialize LocalQuizModel """
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.grammar = QUIZ_GRAMMAR if use_grammar else ""
+        self.session = requests.Session()
+        # Requests are spread over the servers in turn
+        self.requests_made = itertools.count()
+
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic, constrained to the quiz format if the grammar is enabled """
+        return self.query_model(self.quiz_query(topic), self.grammar)
+
+    def generate_reasoning(self, question, correct_answer, incorrect_answer):
+        """ Generate an explanation of why the incorrect answer is wrong """
+        return self.query_model(self.reasoning_query(question, correct_answer, incorrect_answer))
+
+    def query_model(self, query, grammar=""):
+        """ Complete a prompt with the /completion endpoint of the next llama.cpp server """
+        endpoint = self.endpoints[next(self.requests_made) % len(self.endpoints)]
+        body = {"prompt": query,
+                # Reuse the evaluation of the instructions the server already has cached
+                "cache_prompt": True,
+                "grammar": grammar,
+                "n_predict": 500,
+                "temperature": 0.7}
+        response = self.session.post(f"{endpoint}/completion", json=body, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['content']
+
+
+class FakeQuizModel(AbstractQuizModel):
+    """
+    Class to generate deterministic quizzes without a model, after a fixed latency, for development and benchmarks
+    """
+    name = "fake"
+
+    def __init__(self, latency):
+        """ Initialize FakeQuizModel """
+        self.latency = latency
+
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic, the same every time for the same topic """
+        time.sleep(self.latency)
+        digest = hashlib.sha1(topic.encode("utf-8")).digest()
+        lines = []
+        for number in range(1, 4):
+            lines.append(f"QUESTION: Question {number} about {topic}?")
+            lines.extend(f"OPTION {letter}: Answer {letter} to question {number}" for letter in "ABCD")
+            lines.append(f"ANS: {'ABCD'[digest[number] % 4]}")
+        return "\n".join(lines) + "\n"
+
+    def generate_reasoning(self, question, correct_answer, incorrect_answer):
+        """ Generate an explanation of why the incorrect answer is wrong """
+        time.sleep(self.latency)
+        return f"{incorrect_answer} is not the answer to \"{question}\", the correct answer is {correct_answer}."
+
+
+def create_quiz_model(name):
+    """ Create the model named in the QUIZ_MODEL config """
+    if name == GradientQuizModel.name:
+        return GradientQuizModel()
+    if name == LocalQuizModel.name:
+        return LocalQuizModel(app.config["LLAMA_ENDPOINTS"], app.config["LLAMA_TIMEOUT"],
+                              app.config["LLAMA_USE_GRAMMAR"])
+    if name == FakeQuizModel.name:
+        return FakeQuizModel(app.config["QUIZ_FAKE_LATENCY"])
+    raise ValueError(f"Unknown QUIZ_MODEL {name!r}, expected gradient, local or fake")
+
+
+class QuizManager:
+    """
+    QuizManager class to manage quiz generation and storage
+    """
+
+    # Number of incomplete quizzes each user should have available
+    quizzes_per_user = 3
+
+    def __init__(self, model):
+        """ Initialize QuizManager with the model to generate quizzes and explanations with """
+        self.model = model
+
+        # Worker pool for quiz generation, with a global cap on concurrent model calls
+        self.executor = ThreadPoolExecutor(max_workers=app.config["QUIZ_WORKERS"], thread_name_prefix="quiz")
+        self.model_slots = threading.BoundedSemaphore(app.config["QUIZ_MAX_CONCURRENCY"])
+        # Held for the duration of a generation run so runs never overlap
+        self.generation_lock = threading.Lock()
+        self.last_run_stats = None
+        # Number of quizzes queued or being generated for each user, so the same deficit isn't filled twice
+        self.in_flight = Counter()
+        self.in_flight_lock = threading.Lock()
+
+        # Queue of users whose quizzes need replenishing, each user is only queued once at a time
+        self.replenish_queue = queue.Queue()
+        self.queued_users = set()
+        self.queued_users_lock = threading.Lock()
+
+        # Held while the quiz stock is being topped up so fills never overlap
+        self.stock_lock = threading.Lock()
+
+        # Explanations for incorrect answers are cached, and generated on their own pool so they never wait on quizzes
+        self.reasoning_cache = ReasoningCache(app.config["REASONING_CACHE_SIZE"])
+        self.reasoning_executor = ThreadPoolExecutor(max_workers=app.config["REASONING_WORKERS"],
+                                                     thread_name_prefix="reasoning")
+        # Explanations currently being generated, so concurrent requests for the same one share a single model call
+        self.reasoning_futures = {}
+        self.reasoning_lock = threading.Lock()
+
+    def start(self):
+        """ Start the replenish queue worker and the scheduled quiz stock fill and sweep """
+        threading.Thread(target=self.process_replenish_queue, name="quiz-replenish", daemon=True).start()
+
+        # Initialize scheduler to keep the quiz stock full, and to periodically reconcile any quizzes missed by the
+        # replenish queue
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(self.fill_quiz_stock, 'interval', minutes=1, next_run_time=datetime.now(),
+                          max_instances=1, coalesce=True)
+        scheduler.add_job(self.generate_quizzes, 'interval', minutes=app.config["QUIZ_SWEEP_MINUTES"],
+                          max_instances=1, coalesce=True)
+        scheduler.start()
+
+    @staticmethod
+    def process_quiz(quiz_text):
+        """ Process quiz text and return quiz data """
+        parsed = parse_quiz(quiz_text)
+        if parsed['errors']:
+            app.logger.info("Rejected parts of generated quiz: %s", "; ".join(parsed['errors']))
+        return parsed['questions']
+
+    def stock_quiz(self, topic, user_id=None):
+        """ Generate a quiz for a topic and add it to the quiz stock, optionally already assigned to a user """
+        with self.model_slots:
+            quiz_text = self.model.generate_quiz(topic)
+        stock = {'topic': topic, 'questions': self.process_quiz(quiz_text), 'uses': 0, 'assigned_to': [],
+                 'created': datetime.utcnow()}
+        self.record_parse(stock['questions'])
+        if user_id is not None:
+            stock['uses'] = 1
+            stock['assigned_to'].append(user_id)
+        # Quizzes that failed to parse are never shared
+        if stock['questions']:
+            mongo.db.quiz_stock.insert_one(stock)
+        return stock
+
+    @staticmethod
+    def record_parse(questions):
+        """ Count whether the generated quiz parsed into the three questions asked for """
+        metrics.increment("quiz_parses")
+        if not questions:
+            metrics.increment("quiz_parse_failures")
+        elif len(questions) < 3:
+            metrics.increment("quiz_parse_partial")
+
+    @staticmethod
+    def draw_stock_quiz(topic, user_id):
+        """ Take a quiz for a topic from the stock that has not already been given to the user """
+        # The filter and update are applied atomically, so a user can never be given the same stocked quiz twice
+        return mongo.db.quiz_stock.find_one_and_update(
+            {'topic': topic, 'uses': {'$lt': app.config["QUIZ_STOCK_MAX_USES"]}, 'assigned_to': {'$ne': user_id}},
+            {'$inc': {'uses': 1}, '$push': {'assigned_to': user_id}},
+            projection={'questions': 1},
+            sort=[('uses', 1)]
+        )
+
+    def store_quiz(self, topic, user_id):
+        """ Store a quiz for the user in MongoDB, drawing it from the quiz stock where possible """
+        stock = self.draw_stock_quiz(topic, user_id)
+        if stock is None:
+            # Nothing left in stock that the user hasn't seen, so generate a new quiz
+            stock = self.stock_quiz(topic, user_id)
+        quiz = {'user_id': user_id, 'complete': False, 'selected_answers': [], 'topic': topic,
+                'questions': stock['questions'], 'score': 0, 'stock_id': stock.get('_id')}
+        mongo.db.quizzes.insert_one(quiz)
+        update_stats(user_id, {'quizzes_ready': 1})
+
+    def fill_quiz_stock(self):
+        """ Top up the quiz stock for every topic to the target depth """
+        # Skip this run if the previous one is still in progress
+        if not self.stock_lock.acquire(blocking=False):
+            return
+        try:
+            max_uses = app.config["QUIZ_STOCK_MAX_USES"]
+            # Quizzes that have been given to the maximum number of users are no longer needed
+            mongo.db.quiz_stock.delete_many({'uses': {'$gte': max_uses}})
+
+            # Count the quizzes still available for each topic
+            available = {row['_id']: row['count'] for row in mongo.db.quiz_stock.aggregate([
+                {'$match': {'uses': {'$lt': max_uses}}},
+                {'$group': {'_id': '$topic', 'count': {'$sum': 1}}}
+            ])}
+
+            futures = [self.executor.submit(self.stock_quiz, topic) for topic in INTERESTS
+                       for _ in range(app.config["QUIZ_STOCK_DEPTH"] - available.get(topic, 0))]
+            stocked = 0
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    app.logger.error("Failed to stock quiz: %s", future.exception())
+                elif future.result()['questions']:
+                    stocked += 1
+            if futures:
+                app.logger.info("Added %d of %d quizzes to the quiz stock", stocked, len(futures))
+        finally:
+            self.stock_lock.release()
+
+    def generate_quiz(self, topic, user_id):
+        """ Generate and store a single quiz for a user """
+        try:
+            self.store_quiz(topic, user_id)
+            return user_id
+        except Exception:
+            app.logger.exception("Failed to generate quiz for user %s", user_id)
+            raise
+        finally:
+            with self.in_flight_lock:
+                self.in_flight[user_id] -= 1
+                if self.in_flight[user_id] <= 0:
+                    del self.in_flight[user_id]
+
+    def queue_quizzes(self, user):
+        """ Queue generation of the quizzes a user is missing, and return the futures """
+        with self.in_flight_lock:
+            missing = max(user['deficit'] - self.in_flight[user['_id']], 0)
+            self.in_flight[user['_id']] += missing
+        # Generate each quiz for a random interest
+        return [self.executor.submit(self.generate_quiz, random.choice(user['interests']), user['_id'])
+                for _ in range(missing)]
+
+    def request_replenish(self, user_id):
+        """ Queue a user to have their quizzes replenished """
+        with self.queued_users_lock:
+            if user_id in self.queued_users:
+                return
+            self.queued_users.add(user_id)
+        self.replenish_queue.put(user_id)
+
+    def process_replenish_queue(self):
+        """ Generate the missing quizzes for each user taken from the replenish queue """
+        while True:
+            user_id = self.replenish_queue.get()
+            # Remove the user before planning so any change made from here on queues them again
+            with self.queued_users_lock:
+                self.queued_users.discard(user_id)
+            try:
+                for user in self.plan_deficits(user_id):
+                    self.queue_quizzes(user)
+            except Exception:
+                app.logger.exception("Failed to replenish quizzes for user %s", user_id)
+
+    def plan_deficits(self, user_id=None):
+        """
+        Find the users that are missing quizzes, and how many each is missing, from the count of quizzes ready kept in
+        their stats
+        """
+        # Skip users with no interests, optionally limited to a single user. Matching on the type of the interests
+        # (rather than on the array being non-empty) lets the interests index skip users without any
+        match = {"interests": {"$type": "string"}}
+        if user_id is not None:
+            match["_id"] = user_id
+        pipeline = [
+            # Only load the fields needed for generation
+            {"$match": match},
+            {"$project": {"interests": 1}},
+            # Join each user's stats by id, a single small document, rather than any of their quizzes
+            {"$lookup": {
+                "from": "stats",
+                "localField": "_id",
+                "foreignField": "_id",
+                "as": "stats"
+            }},
+            {"$project": {
+                "interests": 1,
+                "has_stats": {"$gt": [{"$size": "$stats"}, 0]},
+                "deficit": {"$subtract": [self.quizzes_per_user,
+                                          {"$ifNull": [{"$arrayElemAt": ["$stats.quizzes_ready", 0]}, 0]}]}
+            }},
+            # Only return users that need quizzes
+            {"$match": {"deficit": {"$gt": 0}}}
+        ]
+        for user in mongo.db.users.aggregate(pipeline):
+            if not user.pop('has_stats'):
+                # Users with quizzes from before stats were stored have their stats created from them, once
+                user['deficit'] = self.quizzes_per_user - create_stats(user['_id'])['quizzes_ready']
+                if user['deficit'] <= 0:
+                    continue
+            yield user
+
+    def generate_quizzes(self):
+        """ Generate quizzes for users """
+        # Skip this run if the previous one is still in progress
+        if not self.generation_lock.acquire(blocking=False):
+            app.logger.warning("Previous quiz generation run is still in progress, skipping")
+            return
+        try:
+            start_time = time.monotonic()
+
+            # Queue a generation task for every quiz each user is missing
+            futures = []
+            for user in self.plan_deficits():
+                futures.extend(self.queue_quizzes(user))
+
+            # Wait for the run to finish and record its throughput
+            quizzes_generated = 0
+            users_covered = set()
+            for future in as_completed(futures):
+                # Failures are logged by generate_quiz
+                if future.exception() is None:
+                    users_covered.add(future.result())
+                    quizzes_generated += 1
+
+            elapsed = time.monotonic() - start_time
+            self.last_run_stats = {
+                "quizzes_generated": quizzes_generated,
+                "failed": len(futures) - quizzes_generated,
+                "users_covered": len(users_covered),
+                "seconds": elapsed,
+                "quizzes_per_second": quizzes_generated / elapsed if elapsed > 0 else 0.0
+            }
+            if futures:
+                app.logger.info("Generated %d quizzes for %d users in %.1fs (%.2f quizzes/sec, %d failed)",
+                                quizzes_generated, len(users_covered), elapsed,
+                                self.last_run_stats["quizzes_per_second"], self.last_run_stats["failed"])
+        finally:
+            self.generation_lock.release()
+
+    def get_cached_reasoning(self, question, correct_answer, incorrect_answer):
+        """ Get reasoning for an incorrect answer, only calling the model if it has not been generated before """
+        key = ReasoningCache.make_key(question, correct_answer, incorrect_answer)
+        reasoning = self.reasoning_cache.get(key)
+        if reasoning is None:
+            reasoning = self.model.generate_reasoning(question, correct_answer, incorrect_answer)
+            self.reasoning_cache.put(key, reasoning)
+        return reasoning
+
+    def request_reasoning(self, question, correct_answer, incorrect_answer):
+        """ Get a future for the reasoning for an incorrect answer, generating it in the background if not cached """
+        key = ReasoningCache.make_key(question, correct_answer, incorrect_answer)
+        reasoning = self.reasoning_cache.get(key)
+        if reasoning is not None:
+            future = Future()
+            future.set_result(reasoning)
+            return future
+
+        with self.reasoning_lock:
+            future = self.reasoning_futures.get(key)
+            if future is not None:
+                return future
+            future = self.reasoning_executor.submit(self.get_cached_reasoning, question, correct_answer, incorrect_answer)
+            self.reasoning_futures[key] = future
+        future.add_done_callback(lambda _: self.forget_reasoning(key))
+        return future
+
+    def forget_reasoning(self, key):
+        """ Stop tracking an explanation once it has been generated """
+        with self.reasoning_lock:
+            self.reasoning_futures.pop(key, None)
+
+    @staticmethod
+    def log_reasoning_failure(future):
+        """ Log the error if generating an explanation failed """
+        if future.exception() is not None:
+            app.logger.error("Failed to generate reasoning: %s", future.exception())
+
+    def queue_reasoning(self, questions, selected_answers):
+        """ Generate reasoning in the background for each incorrectly answered question """
+        for question, selected_answer in zip(questions, selected_answers):
+            if question['correct_answer'] != selected_answer and selected_answer in ANSWER_TO_INDEX:
+                future = self.request_reasoning(question['question'], question['correct_answer'],
+                                                question['options'][ANSWER_TO_INDEX[selected_answer]])
+                future.add_done_callback(self.log_reasoning_failure)
 
 
 class Register(Resource):
@@ -142,22 +762,23 @@ class Register(Resource):
         if not data.get('username') or not data.get('password') or not data.get('email') or not data.get('phone_number'):
             return {"msg": "Missing required fields"}, 400
 
-        # Check if user already exists
-        existing_user = mongo.db.users.find_one({'$or': [{'username': data['username']}, {'email': data['email']}]})
-        if existing_user:
+        # Hash password and store user in database, the unique indexes reject a username or email already in use
+        try:
+            hashed_password = password_hasher.hash(data['password'])
+        except HasherBusy as e:
+            return {"msg": str(e)}, 503, {"Retry-After": "1"}
+        try:
+            result = mongo.db.users.insert_one({
+                'username': data['username'],
+                'password': hashed_password,
+                'email': data['email'],
+                'phone_number': data['phone_number'],
+                'interests': [],
+                'plan': 'Free'
+            })
+        except DuplicateKeyError:
             return {"msg": "A user with this username or email already exists"}, 400
 
-        # Hash password and store user in database
-        hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
-        result = mongo.db.users.insert_one({
-            'username': data['username'],
-            'password': hashed_password,
-            'email': data['email'],
-            'phone_number': data['phone_number'],
-            'interests': [],
-            'plan': 'Free'
-        })
-
         # Generate access token and return response
         access_token = create_access_token(identity=str(result.inserted_id))
         return {"msg": "User registered successfully", "access_token": access_token,
@@ -179,7 +800,13 @@ class Login(Resource):
 
         # Check if user exists and password is correct
         user = mongo.db.users.find_one({'username': data['username']})
-        if user and bcrypt.check_password_hash(user['password'], data['password']):
+        try:
+            password_correct = user is not None and password_hasher.check(user['password'], data['password'])
+        except HasherBusy as e:
+            return {"msg": str(e)}, 503, {"Retry-After": "1"}
+        if password_correct:
+            # Rehash the password if it was stored at an outdated cost
+            password_hasher.upgrade(mongo.db.users, user, data['password'])
             # Generate access token and return response
             access_token = create_access_token(identity=str(user['_id']))
             return {"msg": "Login successful", "access_token": access_token,
@@ -198,11 +825,6 @@ class UserInterests(Resource):
         # Get current user
         current_user = get_jwt_identity()
         user_id = ObjectId(current_user)
-        # Get user from database
-        user = mongo.db.users.find_one({'_id': user_id})
-        # Check if user exists and return error if not
-        if user is None:
-            return {'msg': 'User not found'}, 404
 
         # Get request data
         data = request.get_json()
@@ -214,8 +836,14 @@ class UserInterests(Resource):
         if not isinstance(interests, list):
             return {'msg': "'interests' field must be a list"}, 400
 
-        # Update user interests in database and return response
-        mongo.db.users.update_one({'_id': user_id}, {'$set': {'interests': interests}})
+        # Update user interests in database, returning error if the user doesn't exist
+        result = mongo.db.users.update_one({'_id': user_id}, {'$set': {'interests': interests}})
+        if result.matched_count == 0:
+            return {'msg': 'User not found'}, 404
+
+        # Generate any quizzes the user is now missing and return response
+        profile_cache.invalidate(user_id)
+        quiz_manager.request_replenish(user_id)
         return {'msg': "Interests updated successfully"}, 200
 
 
@@ -225,44 +853,78 @@ class Interests(Resource):
     @staticmethod
     def get():
         """ Handle GET request to get list of interests """
-        interests = [
-            "Programming Languages",
-            "Algorithms",
-            "Software Engineering",
-            "Game Development",
-            "Computer Networks",
-            "Data Science",
-            "Operating Systems",
-            "Mobile Development",
-            "Database Systems",
-            "Cloud Computing",
-            "Machine Learning",
-            "Cybersecurity",
-            "Artificial Intelligence",
-            "Data Structures",
-            "Computer Graphics",
-            "Web Development",
-            "Testing",
-            "Embedded Systems"
-        ]
-        return {"interests": interests}, 200
+        return {"interests": INTERESTS}, 200
 
 
 class Quizzes(Resource):
+    # Quiz fields that can be requested with the 'fields' parameter
+    selectable_fields = {'topic', 'complete', 'score', 'questions', 'selected_answers'}
+
     @jwt_required()
     def get(self):
-        """ Handle GET request to fetch all quizzes for the logged-in user """
+        """
+        Handle GET request to fetch quizzes for the logged-in user, optionally filtered with 'complete', paged with
+        'after' and 'limit', and limited to the given 'fields'
+        """
         # Get current user
         current_user = get_jwt_identity()
         user_id = ObjectId(current_user)
-        # Fetch quizzes from database
-        quizzes = mongo.db.quizzes.find({"user_id": user_id})
+        query = {"user_id": user_id}
+
+        # Filter on whether the quiz is complete
+        complete = request.args.get('complete')
+        if complete is not None:
+            if complete not in ('true', 'false'):
+                return {"msg": "'complete' must be true or false"}, 400
+            query['complete'] = complete == 'true'
+
+        # Continue from the last quiz of the previous page
+        after = request.args.get('after')
+        if after is not None:
+            try:
+                query['_id'] = {'$gt': ObjectId(after)}
+            except InvalidId:
+                return {"msg": "'after' must be a quiz id"}, 400
+
+        limit = request.args.get('limit')
+        if limit is not None:
+            max_limit = app.config["QUIZ_PAGE_MAX_LIMIT"]
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if not 0 < limit <= max_limit:
+                return {"msg": f"'limit' must be an integer from 1 to {max_limit}"}, 400
+
+        # Only fetch the requested fields, otherwise everything except the internal reference to the quiz stock
+        fields = request.args.get('fields')
+        if fields is not None:
+            fields = set(fields.split(','))
+            if not fields <= self.selectable_fields:
+                return {"msg": f"'fields' must be a comma separated list of {sorted(self.selectable_fields)}"}, 400
+            projection = dict.fromkeys(fields, 1)
+        else:
+            projection = {"stock_id": 0}
+
+        # Fetch quizzes from database, in id order so the last id can be used as the cursor for the next page
+        quizzes = mongo.db.quizzes.find(query, projection).sort('_id', 1)
+        if limit is not None:
+            quizzes = quizzes.limit(limit)
+
         # Convert quizzes to a list (including the quiz id) and return
         quizzes_list = []
         for quiz in quizzes:
-            quiz_dict = {**quiz, "quiz_id": str(quiz["_id"]), "user_id": str(quiz["user_id"]), "_id": None}
-            quizzes_list.append(quiz_dict)
-        return {"quizzes": quizzes_list}, 200
+            quiz['quiz_id'] = str(quiz['_id'])
+            quiz['_id'] = None
+            if 'user_id' in quiz:
+                quiz['user_id'] = str(quiz['user_id'])
+            quizzes_list.append(quiz)
+
+        response = {"quizzes": quizzes_list}
+        if limit is not None:
+            # A full page means there may be more quizzes to fetch
+            response['next'] = quizzes_list[-1]['quiz_id'] if len(quizzes_list) == limit else None
+        return response, 200
 
     @jwt_required()
     def put(self):
@@ -274,28 +936,55 @@ class Quizzes(Resource):
         # Check if 'quiz_id' and 'selected_answers' fields are present
         if not data.get('quiz_id') or not data.get('selected_answers'):
             return {"msg": "Missing required fields"}, 400
+        selected_answers = data['selected_answers']
+        if not isinstance(selected_answers, list):
+            return {"msg": "'selected_answers' field must be a list"}, 400
 
         user_id = ObjectId(current_user)
         quiz_id = ObjectId(data['quiz_id'])
-        # Fetch the quiz from the database
-        quiz = mongo.db.quizzes.find_one({"_id": quiz_id, "user_id": user_id})
-        if not quiz:
-            return {"msg": "Quiz not found"}, 404
-
-        # Calculate the score
-        score = 0
-        for question, selected_answer in zip(quiz['questions'], data['selected_answers']):
-            if question['correct_answer'] == selected_answer:
-                score += 1
-
-        # Update quiz in database
-        mongo.db.quizzes.update_one(
-            {"_id": quiz_id, "user_id": user_id},
-            {"$set": {"selected_answers": data['selected_answers'], "complete": True, "score": score}}
+        # Score and complete the quiz in a single update, which only matches the quiz until it is completed so a
+        # repeated submission can't be counted twice
+        quiz = mongo.db.quizzes.find_one_and_update(
+            {"_id": quiz_id, "user_id": user_id, "complete": False},
+            [{"$set": {"selected_answers": {"$literal": selected_answers}, "complete": True,
+                       "score": score_expression(selected_answers)}}],
+            projection={"questions": 1, "score": 1},
+            return_document=ReturnDocument.AFTER
         )
+        if quiz is None:
+            return already_completed(quiz_id, user_id, selected_answers)
+
+        # Update the user's stats
+        update_stats(user_id, {'total_questions': len(quiz['questions']), 'correct_answers': quiz['score'],
+                               'quizzes_ready': -1})
+        profile_cache.invalidate(user_id)
+
+        # Replace the completed quiz and prepare the explanations for any incorrect answers
+        quiz_manager.request_replenish(user_id)
+        quiz_manager.queue_reasoning(quiz['questions'], selected_answers)
         return {"msg": "Quiz updated successfully"}, 200
 
 
+def score_expression(selected_answers):
+    """ Aggregation expression counting the questions answered correctly, for the database to score a quiz with """
+    return {"$add": [{"$cond": [{"$eq": [{"$arrayElemAt": ["$questions.correct_answer", index]},
+                                         {"$literal": selected_answer}]}, 1, 0]}
+                     for index, selected_answer in enumerate(selected_answers)]}
+
+
+def already_completed(quiz_id, user_id, selected_answers):
+    """
+    Response to submitting answers to a quiz that wasn't updated, as it doesn't exist or has been completed. Repeating
+    the submission that completed it succeeds without changing anything, while different answers are refused
+    """
+    quiz = mongo.db.quizzes.find_one({"_id": quiz_id, "user_id": user_id}, {"selected_answers": 1})
+    if quiz is None:
+        return {"msg": "Quiz not found"}, 404
+    if quiz['selected_answers'] != selected_answers:
+        return {"msg": "Quiz already completed"}, 409
+    return {"msg": "Quiz updated successfully"}, 200
+
+
 class Stats(Resource):
     @jwt_required()
     def get(self):
@@ -316,39 +1005,130 @@ class SharedProfile(Resource):
     def get(_id):
         """ Handle GET request to fetch a shared profile """
         user_id = ObjectId(_id)
-        # Fetch user from database
-        user = mongo.db.users.find_one({"_id": user_id})
 
-        if user is None:
-            return "User not found", 404
+        # Use the cached page if the profile has been rendered recently
+        entry = profile_cache.get(user_id)
+        if entry is None:
+            # Noted before reading the profile, so a change made while it renders stops the page being cached
+            started = time.monotonic()
+            # Fetch user from database
+            user = mongo.db.users.find_one({"_id": user_id}, {"username": 1})
 
-        # Gets the stats for the user
-        stats = get_stats(user_id)
+            if user is None:
+                return "User not found", 404
+
+            # Gets the stats for the user
+            stats = get_stats(user_id)
 
-        # Render the profile template and pass in the user
-        html = render_template('SharedProfile.html', user=user, stats=stats)
+            # Render the profile template and pass in the user
+            html = render_template('SharedProfile.html', user=user, stats=stats)
+            entry = profile_cache.put(user_id, html, started)
 
-        # Return a response with the HTML string and content type set to 'text/html'
-        return Response(html, mimetype='text/html')
+        # Return a response with the HTML string and content type set to 'text/html', or 304 Not Modified if the
+        # client already has this version
+        response = Response(entry['html'], mimetype='text/html')
+        response.set_etag(entry['etag'])
+        response.last_modified = entry['last_modified']
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
 
 
 def get_stats(user_id):
-    # Fetch quizzes from database
-    quizzes = mongo.db.quizzes.find({"user_id": user_id})
+    """ Get the stats for a user, kept up to date as quizzes are stored and completed """
+    stats = mongo.db.stats.find_one({"_id": user_id})
 
-    # Calculate total questions, correct answers, and quizzes ready
-    total_questions = 0
-    correct_answers = 0
-    quizzes_ready = 0
-    for quiz in quizzes:
-        if quiz['complete']:
-            total_questions += len(quiz['questions'])
-            correct_answers += quiz['score']
-        else:
-            quizzes_ready += 1
+    # Users without a stats document yet have theirs calculated from their quizzes
+    if stats is None:
+        stats = create_stats(user_id)
 
     # Return stats
-    return {"total_questions": total_questions, "correct_answers": correct_answers, "quizzes_ready": quizzes_ready}
+    return {"total_questions": stats.get('total_questions', 0), "correct_answers": stats.get('correct_answers', 0),
+            "quizzes_ready": stats.get('quizzes_ready', 0)}
+
+
+def create_stats(user_id):
+    """
+    Create a user's stats document from their quizzes, returning the stored document. If another request created it
+    first, that one is kept, so increments already applied to it are never overwritten
+    """
+    stats = {"total_questions": 0, "correct_answers": 0, "quizzes_ready": 0, **calculate_stats(user_id).get(user_id, {})}
+    stats.pop('_id', None)
+    return mongo.db.stats.find_one_and_update({'_id': user_id}, {'$setOnInsert': stats}, upsert=True,
+                                              return_document=ReturnDocument.AFTER)
+
+
+def update_stats(user_id, increments):
+    """
+    Apply increments to a user's stats after their quizzes have changed. Users without a stats document yet (such as
+    those with quizzes from before stats were stored) have the whole document created from their quizzes instead, as
+    upserting the increments alone would leave it missing everything before
+    """
+    result = mongo.db.stats.update_one({'_id': user_id}, {'$inc': increments})
+    if result.matched_count == 0:
+        # The change has already been made to the quizzes, so the calculated stats include it
+        create_stats(user_id)
+
+
+def calculate_stats(user_id=None):
+    """ Calculate the stats for each user (or a single user) from their quizzes """
+    pipeline = [
+        # Calculate total questions, correct answers, and quizzes ready
+        {"$group": {
+            "_id": "$user_id",
+            "total_questions": {"$sum": {"$cond": ["$complete", {"$size": "$questions"}, 0]}},
+            "correct_answers": {"$sum": {"$cond": ["$complete", "$score", 0]}},
+            "quizzes_ready": {"$sum": {"$cond": ["$complete", 0, 1]}}
+        }}
+    ]
+    if user_id is not None:
+        pipeline.insert(0, {"$match": {"user_id": user_id}})
+    return {stats['_id']: stats for stats in mongo.db.quizzes.aggregate(pipeline)}
+
+
+@app.cli.command("rebuild-stats")
+@click.option("--verify", is_flag=True, help="Only report users whose stats do not match their quizzes.")
+def rebuild_stats(verify):
+    """
+    Recalculate every user's stats from their quizzes. Safe to run while the app is serving, as stats that change while
+    they are rebuilt are left for a later run rather than overwritten. With --verify nothing is written, and it exits
+    with an error if any user's stored stats (including those never stored) don't match their quizzes
+    """
+    # Read before the quizzes, so any quiz changed after the stats were read changes them again before they're replaced
+    stored = {stats['_id']: stats for stats in mongo.db.stats.find()}
+    calculated = calculate_stats()
+
+    # Users with stats but no quizzes should have all their counters at zero
+    empty = {"total_questions": 0, "correct_answers": 0, "quizzes_ready": 0}
+    mismatched = []
+    for user_id in calculated.keys() | stored.keys():
+        expected = {**empty, **calculated.get(user_id, {}), "_id": user_id}
+        if {**empty, **stored.get(user_id, {})} != expected:
+            mismatched.append(expected)
+
+    if verify:
+        for stats in mismatched:
+            click.echo(f"Stats for user {stats['_id']} do not match, expected {stats}")
+        click.echo(f"{len(mismatched)} of {len(calculated.keys() | stored.keys())} users have mismatched stats")
+        if mismatched:
+            raise SystemExit(1)
+        return
+
+    # Each user's stats are only replaced if they are still as they were read, and only created if still missing
+    writes = []
+    for stats in mismatched:
+        if stats['_id'] in stored:
+            writes.append(ReplaceOne(stored[stats['_id']], stats))
+        else:
+            fields = {key: value for key, value in stats.items() if key != '_id'}
+            writes.append(UpdateOne({"_id": stats['_id']}, {"$setOnInsert": fields}, upsert=True))
+    rebuilt = 0
+    if writes:
+        result = mongo.db.stats.bulk_write(writes)
+        rebuilt = result.modified_count + result.upserted_count
+    click.echo(f"Rebuilt stats for {rebuilt} users")
+    if rebuilt < len(mismatched):
+        click.echo(f"Stats for {len(mismatched) - rebuilt} users changed while rebuilding, run again to rebuild them")
 
 
 class UserBilling(Resource):
@@ -359,11 +1139,6 @@ class UserBilling(Resource):
         # Get current user
         current_user = get_jwt_identity()
         user_id = ObjectId(current_user)
-        # Get user from database
-        user = mongo.db.users.find_one({'_id': user_id})
-        # Check if user exists and return error if not
-        if user is None:
-            return {'msg': 'User not found'}, 404
 
         # Get request data
         data = request.get_json()
@@ -373,12 +1148,18 @@ class UserBilling(Resource):
             return {'msg': "Missing 'plan' field"}, 400
         plan = data['plan']
 
-        # Update user plan in database and return response
-        mongo.db.users.update_one({'_id': user_id}, {'$set': {'plan': plan}})
+        # Update user plan in database, returning error if the user doesn't exist
+        result = mongo.db.users.update_one({'_id': user_id}, {'$set': {'plan': plan}})
+        if result.matched_count == 0:
+            return {'msg': 'User not found'}, 404
+        profile_cache.invalidate(user_id)
         return {'msg': "Plan updated successfully"}, 200
 
 
 class History(Resource):
+    # Supported streaming formats, newline delimited JSON or server-sent events
+    stream_mimetypes = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
     @jwt_required()
     def get(self, history_type):
         """ Handle GET request to fetch all quizzes for the logged-in user """
@@ -388,34 +1169,202 @@ class History(Resource):
         # Fetch quizzes from database
         quizzes = mongo.db.quizzes.find({"user_id": user_id, "complete": True})
         # Filter out the questions in the quizzes based on the history type
-        questions_list = []
-        for quiz in quizzes:
-            topic = quiz['topic']
-            for i, question in enumerate(quiz['questions']):
-                # Check if the question was answered correctly
-                selected_answer = quiz['selected_answers'][i]
-                correct = question['correct_answer'] == selected_answer
-                # Add the selected answer to the question
-                question['selected_answer'] = selected_answer
-                question['topic'] = topic
-                # Add the question to the list based on the history type
-                if history_type == 'all':
-                    questions_list.append(question)
-                elif history_type == 'correct' and correct:
-                    questions_list.append(question)
-                elif history_type == 'incorrect' and not correct:
-                    questions_list.append(question)
-
-        answer_to_index = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
-        # Loop over the questions and get the reasoning for the incorrect answers from the Llama model
-        for question in questions_list:
-            if question['selected_answer'] != question['correct_answer']:
-                selected_index = answer_to_index[question['selected_answer']]
-                question['reasoning'] = quiz_manager.get_reasoning(question['question'], question['correct_answer'],
-                                                                   question['options'][selected_index])
+        questions_list = filter_history(quizzes, history_type)
+
+        # Get the reasoning for the incorrect answers, generated when the quiz was completed or requested from the
+        # Llama model in parallel if it is not cached yet
+        deadline = time.monotonic() + app.config["HISTORY_REASONING_DEADLINE"]
+        reasoning_futures = {}
+        for index, question in enumerate(questions_list):
+            # Numbered so streamed questions, which arrive as their reasoning is ready, can be put back in order
+            question['index'] = index
+            # Unanswered questions and invalid answers have no option to explain
+            if (question['selected_answer'] != question['correct_answer']
+                    and question['selected_answer'] in ANSWER_TO_INDEX):
+                selected_index = ANSWER_TO_INDEX[question['selected_answer']]
+                future = quiz_manager.request_reasoning(question['question'], question['correct_answer'],
+                                                        question['options'][selected_index])
+                reasoning_futures.setdefault(future, []).append(question)
+
+        # Optionally stream each question as soon as its reasoning is ready
+        stream_format = request.args.get('stream')
+        if stream_format in self.stream_mimetypes:
+            events = self.stream_questions(questions_list, reasoning_futures, deadline, stream_format)
+            return Response(stream_with_context(events), mimetype=self.stream_mimetypes[stream_format])
+
+        # Wait for the reasoning until the deadline, anything not ready by then is marked as pending
+        wait(reasoning_futures, timeout=max(deadline - time.monotonic(), 0))
+        for future, questions in reasoning_futures.items():
+            self.add_reasoning(future, questions)
 
         return {"questions": questions_list}, 200
 
+    @staticmethod
+    def add_reasoning(future, questions):
+        """ Add the reasoning to the questions, or mark them as pending if it is not available """
+        if future.done() and future.exception() is None:
+            for question in questions:
+                question['reasoning'] = future.result()
+        else:
+            for question in questions:
+                question['reasoning_pending'] = True
+
+    @staticmethod
+    def format_event(question, stream_format):
+        """ Format a question as a line of the stream """
+        if stream_format == 'sse':
+            return f"data: {json.dumps(question)}\n\n"
+        return json.dumps(question) + "\n"
+
+    def stream_questions(self, questions_list, reasoning_futures, deadline, stream_format):
+        """ Yield the questions that are ready immediately, then the rest as their reasoning arrives """
+        waiting = {id(question) for questions in reasoning_futures.values() for question in questions}
+        for question in questions_list:
+            if id(question) not in waiting:
+                yield self.format_event(question, stream_format)
+
+        remaining = set(reasoning_futures)
+        try:
+            for future in as_completed(reasoning_futures, timeout=max(deadline - time.monotonic(), 0)):
+                remaining.discard(future)
+                self.add_reasoning(future, reasoning_futures[future])
+                for question in reasoning_futures[future]:
+                    yield self.format_event(question, stream_format)
+        except TimeoutError:
+            # Send the questions whose reasoning missed the deadline as pending
+            for future in remaining:
+                self.add_reasoning(future, reasoning_futures[future])
+                for question in reasoning_futures[future]:
+                    yield self.format_event(question, stream_format)
+
+        if stream_format == 'sse':
+            yield "event: done\ndata: {}\n\n"
+
+
+def filter_history(quizzes, history_type):
+    """ List the questions of completed quizzes with the selected answer and topic, filtered by the history type """
+    questions_list = []
+    for quiz in quizzes:
+        topic = quiz['topic']
+        for i, question in enumerate(quiz['questions']):
+            # Check if the question was answered correctly, with None for questions left unanswered
+            selected_answer = quiz['selected_answers'][i] if i < len(quiz['selected_answers']) else None
+            correct = question['correct_answer'] == selected_answer
+            # Add the selected answer to the question
+            question['selected_answer'] = selected_answer
+            question['topic'] = topic
+            # Add the question to the list based on the history type
+            if history_type == 'all':
+                questions_list.append(question)
+            elif history_type == 'correct' and correct:
+                questions_list.append(question)
+            elif history_type == 'incorrect' and not correct:
+                questions_list.append(question)
+    return questions_list
+
+
+class QuizMetrics(Resource):
+    """ QuizMetrics resource to report quiz generation counters """
+
+    @staticmethod
+    def get():
+        """ Handle GET request to fetch the quiz generation counters """
+        counters = metrics.snapshot()
+        parses = counters.get("quiz_parses", 0)
+        parse_success_rate = 1 - counters.get("quiz_parse_failures", 0) / parses if parses else None
+        return {"counters": counters, "parse_success_rate": parse_success_rate,
+                "model": quiz_manager.model.name, "last_run": quiz_manager.last_run_stats}, 200
+
+
+def ensure_indexes():
+    """
+    Create any missing indexes from the index manifest. Startup fails without the unique indexes on users, as
+    registering relies on them alone to reject a username or email that is already taken
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            mongo.db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # Existing data (e.g. duplicate usernames) can stop an index being built. The app still works without the
+            # others, but not without those on users
+            app.logger.error("Failed to create indexes for %s: %s", collection, e)
+            if collection == "users":
+                raise
+
+
+def find_collection_scans(explain):
+    """ Return the stages of the winning plans in an explain result that scan a whole collection """
+    scans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                scans.extend(find_plan_stages(value, 'COLLSCAN'))
+            else:
+                scans.extend(find_collection_scans(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            scans.extend(find_collection_scans(value))
+    return scans
+
+
+def find_plan_stages(plan, stage):
+    """ Return every stage of the given type in a query plan """
+    stages = []
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            stages.append(plan)
+        for value in plan.values():
+            stages.extend(find_plan_stages(value, stage))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_plan_stages(value, stage))
+    return stages
+
+
+@app.cli.command("audit-indexes")
+def audit_indexes():
+    """ Explain every query shape the app makes and fail if any of them scans a whole collection """
+    # Every find, update and aggregation made while serving requests and generating quizzes, as the equivalent
+    # find or aggregation (rebuild-stats is an offline full recalculation and is deliberately not included)
+    user_id = ObjectId()
+    topic = INTERESTS[0]
+    max_uses = app.config["QUIZ_STOCK_MAX_USES"]
+    finds = [
+        ("users", {'username': "username"}, None),
+        ("users", {'_id': user_id}, None),
+        ("quizzes", {"user_id": user_id}, [('_id', 1)]),
+        ("quizzes", {"user_id": user_id, "complete": False, "_id": {'$gt': ObjectId()}}, [('_id', 1)]),
+        ("quizzes", {"_id": ObjectId(), "user_id": user_id}, None),
+        ("quizzes", {"user_id": user_id, "complete": True}, None),
+        ("quiz_stock", {'topic': topic, 'uses': {'$lt': max_uses}, 'assigned_to': {'$ne': user_id}}, [('uses', 1)]),
+        ("quiz_stock", {'uses': {'$gte': max_uses}}, None),
+        ("stats", {'_id': user_id}, None),
+        ("reasonings", {'_id': ReasoningCache.make_key("question", "A", "option")}, None)
+    ]
+    aggregations = [
+        ("users", [{"$match": {"interests": {"$type": "string"}}}, {"$project": {"interests": 1}}]),
+        ("users", [{"$match": {"interests": {"$type": "string"}, "_id": user_id}}, {"$project": {"interests": 1}}]),
+        ("quizzes", [{"$match": {"user_id": user_id}}, {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}]),
+        ("quiz_stock", [{'$match': {'uses': {'$lt': max_uses}}}, {'$group': {'_id': '$topic', 'count': {'$sum': 1}}}])
+    ]
+
+    failures = 0
+    for collection, query, sort in finds:
+        cursor = mongo.db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        scans = find_collection_scans(cursor.explain())
+        failures += bool(scans)
+        click.echo(f"{'COLLSCAN' if scans else 'ok':8} {collection}.find({query})")
+    for collection, pipeline in aggregations:
+        scans = find_collection_scans(mongo.db.command('aggregate', collection, pipeline=pipeline, explain=True))
+        failures += bool(scans)
+        click.echo(f"{'COLLSCAN' if scans else 'ok':8} {collection}.aggregate({pipeline})")
+
+    if failures:
+        click.echo(f"{failures} queries scan a whole collection")
+        raise SystemExit(1)
+
 
 # Add resources to API
 api.add_resource(Register, '/register')
@@ -427,5 +1376,25 @@ api.add_resource(Stats, '/stats')
 api.add_resource(SharedProfile, '/sharedprofile/<string:_id>')
 api.add_resource(UserBilling, '/userbilling')
 api.add_resource(History, '/history/<string:history_type>')
+api.add_resource(QuizMetrics, '/metrics')
+
+ensure_indexes()
+
+metrics = Metrics()
+profile_cache = ProfileCache(app.config["SHARED_PROFILE_TTL"], app.config["SHARED_PROFILE_CACHE_SIZE"],
+                             app.config["SHARED_PROFILE_SNAPSHOT_DIR"])
+quiz_manager = QuizManager(create_quiz_model(app.config["QUIZ_MODEL"]))
+
+
+def start_background_work():
+    """
+    Start generating quizzes in the background. Called by the servers (serve.py, or running app.py directly) rather
+    than on import, so CLI commands such as rebuild-stats and audit-indexes don't start generating quizzes alongside
+    them
+    """
+    quiz_manager.start()
+
 
-quiz_manager = QuizManager()
+if __name__ == "__main__":
+    start_background_work()
+    app.run()
@@ -0,0 +1,202 @@
+"""
+Fuzz and adversarial corpus for parsing.py, checking that parse time stays linear in the length of the text on
+malformed and garbage model output, and that the parsers only ever return well formed results.
+
+Run from this directory with `python fuzz_parsing.py`. With --legacy it also times the regular expressions parsing.py
+replaced, each in a subprocess that is killed after --timeout seconds.
+"""
+import argparse
+import multiprocessing
+import random
+import re
+import string
+import sys
+import time
+
+from parsing import QUIZ_ANSWERS, QUIZ_MARKERS, STORY_MARKERS, StoryParser, parse_quiz, parse_story
+
+LEGACY_QUIZ_PATTERN = (r'QUESTION: (.+?)\n(?:OPTION A: (.+?)\n)+(?:OPTION B: (.+?)\n)+(?:OPTION C: (.+?)\n)+'
+                       r'(?:OPTION D: (.+?)\n)+ANS: (.+?)')
+LEGACY_STORY_PATTERN = (r"(?<=STORY:)(.*?)(?=OPTION_A:)|(OPTION_A:.*?)(?=OPTION_B:)|(OPTION_B:.*?)(?=OPTION_C:)|"
+                        r"(OPTION_C:.*)")
+
+WELL_FORMED_QUIZ = (
+    "QUESTION: What is the time complexity of binary search?\n"
+    "OPTION A: O(n)\n"
+    "OPTION B: O(log n)\n"
+    "OPTION C: O(n log n)\n"
+    "OPTION D: O(1)\n"
+    "ANS: B\n"
+)
+WELL_FORMED_STORY = (
+    "STORY: The lantern flickered as the door creaked open.\n\n"
+    "A cold wind carried the smell of salt: the sea was close.\n"
+    "OPTION_A: Continue...\n"
+    "OPTION_B: Step inside: carefully\n"
+    "OPTION_C: Call out to whoever is there\n"
+)
+
+
+def repeat_to(text, size):
+    """ Repeat text until it is at least size characters long """
+    return text * (size // len(text) + 1)
+
+
+def adversarial_corpus(size):
+    """ Inputs built to trigger backtracking or quadratic behaviour, each about size characters long """
+    return [
+        ("quiz: repeated OPTION A lines", "QUESTION: q\n" + repeat_to("OPTION A: x\n", size)),
+        ("quiz: options without ANS", "QUESTION: q\n" + repeat_to("OPTION A: a\nOPTION B: b\nOPTION C: c\nOPTION D: d\n", size)),
+        ("quiz: markers without spaces or newlines", repeat_to("QUESTION:OPTION A:OPTION B:ANS:", size)),
+        ("quiz: marker prefixes", repeat_to("OPTION OPTIO QUESTIO AN", size)),
+        ("quiz: one huge question", "QUESTION: " + repeat_to("why ", size)),
+        ("quiz: repeated well formed", repeat_to(WELL_FORMED_QUIZ, size)),
+        ("story: repeated STORY markers", repeat_to("STORY: ", size)),
+        ("story: options without story", repeat_to("OPTION_A: a OPTION_B: b OPTION_C: c ", size)),
+        ("story: marker prefixes", repeat_to("OPTION_OPTION_OPTIO STOR", size)),
+        ("story: colons everywhere", "STORY: " + repeat_to("a: b: c:: ", size)),
+        ("story: one huge paragraph", "STORY: " + repeat_to("and then ", size) + "\nOPTION_A: go"),
+        ("story: repeated well formed", repeat_to(WELL_FORMED_STORY, size)),
+    ]
+
+
+def random_corpus(rng, count, size):
+    """ Random text from an alphabet weighted towards marker fragments, whitespace and punctuation """
+    fragments = list(QUIZ_MARKERS + STORY_MARKERS) + ["OPTION", "OPTION_", "QUEST", "ANS", ":", "\n", " ", "A", "B"]
+    alphabet = string.ascii_letters + string.digits + string.punctuation + " \n\té中\U0001f600"
+    corpus = []
+    for index in range(count):
+        parts = []
+        length = 0
+        while length < size:
+            part = rng.choice(fragments) if rng.random() < 0.3 else "".join(rng.choices(alphabet, k=rng.randint(1, 12)))
+            parts.append(part)
+            length += len(part)
+        corpus.append((f"random {index}", "".join(parts)))
+    return corpus
+
+
+def check_results(text, rng):
+    """ Return the problems with parsing some text, if any """
+    problems = []
+    quiz = parse_quiz(text)
+    for question in quiz['questions']:
+        if len(question['options']) != 4 or question['correct_answer'] not in QUIZ_ANSWERS:
+            problems.append(f"malformed question {question!r:.80}")
+
+    # Streaming the story in random chunks must give the same result as parsing it at once
+    story = parse_story(text)
+    parser = StoryParser()
+    streamed_story = ""
+    streamed_options = []
+    position = 0
+    while position < len(text):
+        end = position + rng.randint(1, 64)
+        events = parser.feed(text[position:end])
+        position = end
+        for event, value in events:
+            if event == "story":
+                streamed_story += value
+            else:
+                streamed_options.append(value)
+    for event, value in parser.finish():
+        if event == "story":
+            streamed_story += value
+        else:
+            streamed_options.append(value)
+    if (streamed_story, streamed_options) != (story['story'], story['options']):
+        problems.append("streamed story differs from parsed story")
+    if any(not option or option != option.strip() for option in story['options']):
+        problems.append("unstripped or empty option")
+    return problems
+
+
+def time_parse(text, repeat):
+    """ Best time in seconds of parsing text as both a quiz and a story """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse_quiz(text)
+        parse_story(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_legacy(pattern, text):
+    """ Run a legacy pattern over text, in a subprocess """
+    re.compile(pattern, re.DOTALL).findall(text)
+
+
+def time_legacy(text, timeout):
+    """ Time of the legacy quiz and story patterns over text, or None if they didn't finish within the timeout """
+    start = time.perf_counter()
+    for pattern in (LEGACY_QUIZ_PATTERN, LEGACY_STORY_PATTERN):
+        process = multiprocessing.Process(target=run_legacy, args=(pattern, text))
+        process.start()
+        process.join(max(timeout - (time.perf_counter() - start), 0))
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            return None
+    return time.perf_counter() - start
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=[4096, 16384, 65536],
+                                 help="input sizes in characters")
+    argument_parser.add_argument("--random", type=int, default=200, help="random inputs per size")
+    argument_parser.add_argument("--seed", type=int, default=305)
+    argument_parser.add_argument("--repeat", type=int, default=3, help="timing runs per input, the best is kept")
+    argument_parser.add_argument("--max-us-per-kb", type=float, default=2000.0,
+                                 help="slowest allowed parse time per KB of input")
+    argument_parser.add_argument("--max-growth", type=float, default=3.0,
+                                 help="largest allowed growth in time per KB from the smallest to the largest size")
+    argument_parser.add_argument("--legacy", action="store_true", help="also time the legacy regular expressions")
+    argument_parser.add_argument("--timeout", type=float, default=5.0, help="timeout for each legacy run in seconds")
+    args = argument_parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sizes = sorted(args.sizes)
+    failures = []
+    # Time per KB of each adversarial input at each size, to check it doesn't grow with the size
+    per_kb = {}
+
+    header = f"{'input':42} {'size':>7} {'us/KB':>9}"
+    print(header + (f" {'legacy ms':>10}" if args.legacy else ""))
+    for size in sizes:
+        for name, text in adversarial_corpus(size):
+            elapsed = time_parse(text, args.repeat)
+            us_per_kb = elapsed * 1e6 / (len(text) / 1024)
+            per_kb.setdefault(name, {})[size] = us_per_kb
+            line = f"{name:42} {len(text):7} {us_per_kb:9.1f}"
+            if args.legacy:
+                legacy = time_legacy(text, args.timeout)
+                line += f" {'timeout' if legacy is None else f'{legacy * 1000:.1f}':>10}"
+            print(line)
+            failures.extend(f"{name} ({size}): {problem}" for problem in check_results(text, rng))
+            if us_per_kb > args.max_us_per_kb:
+                failures.append(f"{name} ({size}): {us_per_kb:.1f} us/KB")
+
+        slowest = 0.0
+        for name, text in random_corpus(rng, args.random, size):
+            elapsed = time_parse(text, 1)
+            slowest = max(slowest, elapsed * 1e6 / (len(text) / 1024))
+            failures.extend(f"{name} ({size}): {problem}" for problem in check_results(text, rng))
+        print(f"{f'{args.random} random inputs (slowest)':42} {size:7} {slowest:9.1f}")
+        if slowest > args.max_us_per_kb:
+            failures.append(f"random ({size}): {slowest:.1f} us/KB")
+
+    for name, times in per_kb.items():
+        growth = times[sizes[-1]] / times[sizes[0]]
+        if growth > args.max_growth:
+            failures.append(f"{name}: time per KB grew {growth:.1f}x from {sizes[0]} to {sizes[-1]} characters")
+
+    if failures:
+        print("\n".join(["", f"{len(failures)} failures:"] + failures))
+        sys.exit(1)
+    print("\nAll inputs parsed in linear time with well formed results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Single pass parsers for the quiz and story formats the models generate.
+
+Both formats are sections of text introduced by markers (e.g. "QUESTION:" or "OPTION_A:"). The markers are found with
+one precompiled pattern of literal alternatives, which can't backtrack, so parsing is linear in the length of the text
+however malformed it is. Parsers return whatever parsed cleanly along with the reasons anything else was rejected.
+"""
+import re
+
+QUIZ_MARKERS = ("QUESTION:", "OPTION A:", "OPTION B:", "OPTION C:", "OPTION D:", "ANS:")
+QUIZ_OPTION_MARKERS = QUIZ_MARKERS[1:5]
+QUIZ_ANSWERS = "ABCD"
+
+STORY_MARKERS = ("STORY:", "OPTION_A:", "OPTION_B:", "OPTION_C:")
+STORY_OPTION_MARKERS = STORY_MARKERS[1:]
+
+
+class SectionScanner:
+    """
+    Incremental scanner which splits text into markers and the text between them as it streams in
+    """
+
+    def __init__(self, markers):
+        """ Initialise SectionScanner """
+        self.pattern = re.compile("|".join(map(re.escape, markers)))
+        # Every proper prefix of a marker, to hold back text at the end of a chunk that could be the start of one
+        self.prefixes = {marker[:length] for marker in markers for length in range(1, len(marker))}
+        self.longest_prefix = max(map(len, markers)) - 1
+        self.pending = ""
+
+    def feed(self, text):
+        """ Scan the next chunk of text, returning a list of ("marker", marker) and ("text", text) tuples """
+        text = self.pending + text
+        tokens = []
+        position = 0
+        for match in self.pattern.finditer(text):
+            if match.start() > position:
+                tokens.append(("text", text[position:match.start()]))
+            tokens.append(("marker", match.group()))
+            position = match.end()
+
+        # Hold back the longest suffix that could be the start of a marker split across chunks
+        keep = 0
+        for length in range(min(len(text) - position, self.longest_prefix), 0, -1):
+            if text[len(text) - length:] in self.prefixes:
+                keep = length
+                break
+        if len(text) - keep > position:
+            tokens.append(("text", text[position:len(text) - keep]))
+        self.pending = text[len(text) - keep:]
+        return tokens
+
+    def finish(self):
+        """ Return any text held back, once all the text has been fed """
+        tokens = [("text", self.pending)] if self.pending else []
+        self.pending = ""
+        return tokens
+
+
+class QuizParser:
+    """
+    Parser for generated quizzes, which are questions each followed by options A to D and the letter of the answer
+    """
+
+    def __init__(self):
+        """ Initialise QuizParser """
+        self.scanner = SectionScanner(QUIZ_MARKERS)
+        self.section = None
+        self.text = []
+        self.question = None
+        self.question_count = 0
+        self.questions = []
+        self.errors = []
+
+    def feed(self, text):
+        """ Parse the next chunk of text """
+        for kind, value in self.scanner.feed(text):
+            self.add_token(kind, value)
+
+    def finish(self):
+        """ Parse any remaining text, and reject the last question if it is incomplete """
+        for kind, value in self.scanner.finish():
+            self.add_token(kind, value)
+        self.end_section()
+        self.end_question()
+
+    def add_token(self, kind, value):
+        """ Add text to the current section, or start the next section """
+        if kind == "text":
+            if self.section is not None:
+                self.text.append(value)
+            return
+        self.end_section()
+        if value == "QUESTION:":
+            self.end_question()
+            self.question = {"question": None, "options": [], "correct_answer": None, "error": None}
+        elif self.question is None:
+            self.errors.append(f"{value} outside a question")
+        elif self.question['error'] is None:
+            self.check_order(value)
+        self.section = value
+
+    def check_order(self, marker):
+        """ Reject the current question if a marker is out of order """
+        options = self.question['options']
+        if self.question['correct_answer'] is not None:
+            self.question['error'] = f"{marker} after ANS:"
+        elif marker == "ANS:":
+            if len(options) < len(QUIZ_OPTION_MARKERS):
+                self.question['error'] = f"ANS: after {len(options)} options"
+        elif len(options) == len(QUIZ_OPTION_MARKERS) or marker != QUIZ_OPTION_MARKERS[len(options)]:
+            self.question['error'] = f"{marker} out of order"
+
+    def end_section(self):
+        """ Store the text of the current section in the current question """
+        text = "".join(self.text).strip()
+        self.text = []
+        if self.question is None or self.question['error'] is not None:
+            return
+        if self.section == "QUESTION:":
+            self.question['question'] = text
+        elif self.section == "ANS:":
+            # The answer is a single letter, optionally followed by punctuation or the option text
+            if text and text[0] in QUIZ_ANSWERS and not text[1:2].isalnum():
+                self.question['correct_answer'] = text[0]
+            else:
+                self.question['error'] = f"answer {text[:20]!r} is not one of {', '.join(QUIZ_ANSWERS)}"
+        elif self.section in QUIZ_OPTION_MARKERS:
+            self.question['options'].append(text)
+        if text == "" and self.section is not None:
+            self.question['error'] = f"empty {self.section}"
+
+    def end_question(self):
+        """ Keep the current question if it is complete, otherwise record why it was rejected """
+        question = self.question
+        self.question = None
+        if question is None:
+            return
+        self.question_count += 1
+        if question['error'] is None and question['correct_answer'] is None:
+            question['error'] = "no ANS:"
+        if question['error'] is not None:
+            self.errors.append(f"question {self.question_count}: {question['error']}")
+            return
+        self.questions.append({"question": question['question'], "options": question['options'],
+                               "correct_answer": question['correct_answer']})
+
+
+class StoryParser:
+    """
+    Incremental parser for generated stories, which are the story text followed by up to three options. It returns the
+    story text and each option as soon as they are complete, so they can be streamed
+    """
+
+    def __init__(self):
+        """ Initialise StoryParser """
+        self.scanner = SectionScanner(STORY_MARKERS)
+        # The marker of the section currently being parsed, None before the story starts
+        self.section = None
+        # Whitespace at the end of the story so far, only sent if more story text follows
+        self.story_whitespace = ""
+        self.story_started = False
+        self.option = []
+        self.story = ""
+        self.options = []
+        self.errors = []
+        self.seen = set()
+
+    def feed(self, text):
+        """ Parse the next chunk of text, returning a list of (event, text) tuples for the story text and options """
+        events = []
+        for kind, value in self.scanner.feed(text):
+            self.add_token(kind, value, events)
+        return events
+
+    def finish(self):
+        """ Parse any remaining text once the generation is complete, returning the final events """
+        events = []
+        for kind, value in self.scanner.finish():
+            self.add_token(kind, value, events)
+        self.start_section(None, events)
+        if "STORY:" not in self.seen:
+            self.errors.append("no STORY:")
+        if not self.options:
+            self.errors.append("no options")
+        return events
+
+    def add_token(self, kind, value, events):
+        """ Add text to the current section, or start the next section """
+        if kind == "marker":
+            self.start_section(value, events)
+        elif self.section == "STORY:":
+            self.add_story_text(value, events)
+        elif self.section is not None:
+            self.option.append(value)
+
+    def add_story_text(self, text, events):
+        """ Add text to the story, leaving out leading and trailing whitespace """
+        if not self.story_started:
+            text = text.lstrip()
+            self.story_started = bool(text)
+        stripped = text.rstrip()
+        if stripped:
+            delta = self.story_whitespace + stripped
+            self.story += delta
+            events.append(("story", delta))
+            self.story_whitespace = text[len(stripped):]
+        else:
+            self.story_whitespace += text
+
+    def start_section(self, marker, events):
+        """ Finish the current section and start the next """
+        if self.section is not None and self.section != "STORY:":
+            option = "".join(self.option).strip()
+            if option:
+                self.options.append(option)
+                events.append(("option", option))
+            else:
+                self.errors.append(f"empty {self.section}")
+        if marker in STORY_OPTION_MARKERS:
+            index = sum(option_marker in self.seen for option_marker in STORY_OPTION_MARKERS)
+            if index == len(STORY_OPTION_MARKERS) or marker != STORY_OPTION_MARKERS[index]:
+                self.errors.append(f"{marker} out of order")
+        elif marker == "STORY:" and marker in self.seen:
+            self.errors.append("repeated STORY:")
+        if marker is not None:
+            self.seen.add(marker)
+        self.option = []
+        self.section = marker
+
+
+def parse_quiz(text):
+    """ Parse a generated quiz into its complete questions, and the reasons any other questions were rejected """
+    parser = QuizParser()
+    parser.feed(text)
+    parser.finish()
+    return {"questions": parser.questions, "errors": parser.errors}
+
+
+def parse_story(text):
+    """ Parse generated story text into the story and its options, and the reasons for anything malformed """
+    parser = StoryParser()
+    parser.feed(text)
+    parser.finish()
+    return {"story": parser.story, "options": parser.options, "errors": parser.errors}
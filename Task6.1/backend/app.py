@@ -1,5 +1,7 @@
-﻿import os
-import re
+﻿import click
+import logging
+import os
+import requests
 from flask import Flask, request
 from flask_restful import Resource, Api
 from flask_pymongo import PyMongo
@@ -7,10 +9,23 @@ from flask_bcrypt import Bcrypt
 from dotenv import load_dotenv
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
 from gradientai import Gradient
+from collections import Counter
 from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from parsing import parse_quiz
+from passwords import HasherBusy, PasswordHasher, tune_rounds
+import hashlib
+import itertools
+import queue
 import random
+import threading
+import time
 
 # Load environment variables
 load_dotenv()
@@ -19,38 +34,79 @@ load_dotenv()
 app = Flask(__name__)
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")
+# bcrypt cost of password hashes, tuned at startup to take about BCRYPT_TARGET_MS milliseconds per hash (but at least
+# 12) unless set. Stored hashes made at a lower cost are rehashed when their user next logs in
+app.config["BCRYPT_TARGET_MS"] = float(os.getenv("BCRYPT_TARGET_MS", 250))
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS") or tune_rounds(app.config["BCRYPT_TARGET_MS"]))
+# Threads hashing passwords, and how many more hashes can wait for one before sign ins are refused with 503
+app.config["PASSWORD_WORKERS"] = int(os.getenv("PASSWORD_WORKERS", 2))
+app.config["PASSWORD_QUEUE"] = int(os.getenv("PASSWORD_QUEUE", 16))
+# Number of worker threads used to generate quizzes, and the maximum number of concurrent calls to the model
+app.config["QUIZ_WORKERS"] = int(os.getenv("QUIZ_WORKERS", 8))
+app.config["QUIZ_MAX_CONCURRENCY"] = int(os.getenv("QUIZ_MAX_CONCURRENCY", 4))
+# Model quizzes are generated with: "gradient" (the Gradient API), "local" (llama.cpp servers) or "fake" (deterministic
+# output after a fixed latency in seconds, to develop and benchmark without a model)
+app.config["QUIZ_MODEL"] = os.getenv("QUIZ_MODEL", "gradient")
+app.config["QUIZ_FAKE_LATENCY"] = float(os.getenv("QUIZ_FAKE_LATENCY", 0))
+# Comma separated base URLs of the llama.cpp servers for the local model, which are used in turn, the timeout for a
+# single request in seconds, and whether quizzes are constrained by QUIZ_GRAMMAR so they always match the format
+app.config["LLAMA_ENDPOINTS"] = os.getenv("LLAMA_ENDPOINTS", "http://localhost:8080").split(",")
+app.config["LLAMA_TIMEOUT"] = float(os.getenv("LLAMA_TIMEOUT", 120))
+app.config["LLAMA_USE_GRAMMAR"] = os.getenv("LLAMA_USE_GRAMMAR", "true").lower() == "true"
+# Quizzes are replenished as users complete them, so the full sweep only needs to run occasionally as a fallback
+app.config["QUIZ_SWEEP_MINUTES"] = int(os.getenv("QUIZ_SWEEP_MINUTES", 15))
+# Largest page of quizzes that can be requested with the 'limit' parameter
+app.config["QUIZ_PAGE_MAX_LIMIT"] = int(os.getenv("QUIZ_PAGE_MAX_LIMIT", 100))
+
+# Log generation throughput and other background activity
+app.logger.setLevel(logging.INFO)
 
 # Initialize Flask extensions
 mongo = PyMongo(app)
 bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 api = Api(app)
-
-
-class QuizManager:
+password_hasher = PasswordHasher(bcrypt, app.config["BCRYPT_LOG_ROUNDS"], app.config["PASSWORD_WORKERS"],
+                                 app.config["PASSWORD_QUEUE"])
+
+# Indexes for every query the app makes, created at startup
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("interests", ASCENDING)])
+    ],
+    "quizzes": [
+        IndexModel([("user_id", ASCENDING), ("complete", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)])
+    ]
+}
+
+# GBNF grammar for the quiz format, three questions each with four options and the correct answer. Used to constrain
+# generation on backends that support grammars (Gradient's completion API does not)
+QUIZ_GRAMMAR = r'''
+root     ::= question question question
+question ::= "QUESTION: " line "\n" "OPTION A: " line "\n" "OPTION B: " line "\n" "OPTION C: " line "\n" "OPTION D: " line "\n" "ANS: " [ABCD] "\n"
+line     ::= [^\n]+
+'''
+
+
+class AbstractQuizModel(ABC):
     """
-    QuizManager class to manage quiz generation and storage
+    Abstract class for the model quizzes are generated with
     """
+    # Name of the model, as set in the QUIZ_MODEL config
+    name = None
 
-    model_adapter = None
-
-    def __init__(self):
-        """ Initialize QuizManager """
-        # Initialize Gradient API
-        gradient = Gradient()
-        base_model = gradient.get_base_model(base_model_slug="llama2-7b-chat")
-        name = f"Llama_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        self.model_adapter = base_model.create_model_adapter(name=name)
-
-        # Initialize scheduler to generate quizzes
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(self.generate_quizzes, 'interval', minutes=1)
-        scheduler.start()
+    @abstractmethod
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic """
+        pass
 
     @staticmethod
-    def fetch_quiz_from_llama(student_topic, model_adapter):
-        """ Fetch quiz from Llama model """
-        query = (
+    def quiz_query(student_topic):
+        """ Prompt for a quiz on a topic """
+        return (
             f"[INST] Generate a quiz with 3 questions to test students on the provided topic. "
             f"For each question, generate 4 options where only one of the options is correct. "
             f"Format your response as follows:\n"
@@ -65,31 +121,139 @@ class QuizManager:
             f"Here is the student topic:\n{student_topic}"
             f"[/INST]"
         )
-        response = model_adapter.complete(query=query, max_generated_token_count=500).generated_output
-        return response
+
+
+class GradientQuizModel(AbstractQuizModel):
+    """
+    Class to generate quizzes using Gradient API
+    """
+    name = "gradient"
+    model_adapter = None
+
+    def __init__(self):
+        """ Initialize GradientQuizModel """
+        gradient = Gradient()
+        base_model = gradient.get_base_model(base_model_slug="llama2-7b-chat")
+        name = f"Llama_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.model_adapter = base_model.create_model_adapter(name=name)
+
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic, Gradient's completion API can't be constrained by a grammar """
+        query = self.quiz_query(topic)
+        return self.model_adapter.complete(query=query, max_generated_token_count=500).generated_output
+
+
+class LocalQuizModel(AbstractQuizModel):
+    """
+    Class to generate quizzes using llama.cpp servers
+    """
+    name = "local"
+
+    def __init__(self, endpoints, timeout, use_grammar):
+        """ Initialize LocalQuizModel """
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.grammar = QUIZ_GRAMMAR if use_grammar else ""
+        self.session = requests.Session()
+        # Requests are spread over the servers in turn
+        self.requests_made = itertools.count()
+
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic, constrained to the quiz format if the grammar is enabled """
+        return self.query_model(self.quiz_query(topic), self.grammar)
+
+    def query_model(self, query, grammar=""):
+        """ Complete a prompt with the /completion endpoint of the next llama.cpp server """
+        endpoint = self.endpoints[next(self.requests_made) % len(self.endpoints)]
+        body = {"prompt": query,
+                # Reuse the evaluation of the instructions the server already has cached
+                "cache_prompt": True,
+                "grammar": grammar,
+                "n_predict": 500,
+                "temperature": 0.7}
+        response = self.session.post(f"{endpoint}/completion", json=body, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['content']
+
+
+class FakeQuizModel(AbstractQuizModel):
+    """
+    Class to generate deterministic quizzes without a model, after a fixed latency, for development and benchmarks
+    """
+    name = "fake"
+
+    def __init__(self, latency):
+        """ Initialize FakeQuizModel """
+        self.latency = latency
+
+    def generate_quiz(self, topic):
+        """ Generate the text of a quiz on a topic, the same every time for the same topic """
+        time.sleep(self.latency)
+        digest = hashlib.sha1(topic.encode("utf-8")).digest()
+        lines = []
+        for number in range(1, 4):
+            lines.append(f"QUESTION: Question {number} about {topic}?")
+            lines.extend(f"OPTION {letter}: Answer {letter} to question {number}" for letter in "ABCD")
+            lines.append(f"ANS: {'ABCD'[digest[number] % 4]}")
+        return "\n".join(lines) + "\n"
+
+
+def create_quiz_model(name):
+    """ Create the model named in the QUIZ_MODEL config """
+    if name == GradientQuizModel.name:
+        return GradientQuizModel()
+    if name == LocalQuizModel.name:
+        return LocalQuizModel(app.config["LLAMA_ENDPOINTS"], app.config["LLAMA_TIMEOUT"],
+                              app.config["LLAMA_USE_GRAMMAR"])
+    if name == FakeQuizModel.name:
+        return FakeQuizModel(app.config["QUIZ_FAKE_LATENCY"])
+    raise ValueError(f"Unknown QUIZ_MODEL {name!r}, expected gradient, local or fake")
+
+
+class QuizManager:
+    """
+    QuizManager class to manage quiz generation and storage
+    """
+
+    # Number of incomplete quizzes each user should have available
+    quizzes_per_user = 3
+
+    def __init__(self, model):
+        """ Initialize QuizManager with the model to generate quizzes with """
+        self.model = model
+
+        # Worker pool for quiz generation, with a global cap on concurrent model calls
+        self.executor = ThreadPoolExecutor(max_workers=app.config["QUIZ_WORKERS"], thread_name_prefix="quiz")
+        self.model_slots = threading.BoundedSemaphore(app.config["QUIZ_MAX_CONCURRENCY"])
+        # Held for the duration of a generation run so runs never overlap
+        self.generation_lock = threading.Lock()
+        self.last_run_stats = None
+        # Number of quizzes queued or being generated for each user, so the same deficit isn't filled twice
+        self.in_flight = Counter()
+        self.in_flight_lock = threading.Lock()
+
+        # Queue of users whose quizzes need replenishing, each user is only queued once at a time
+        self.replenish_queue = queue.Queue()
+        self.queued_users = set()
+        self.queued_users_lock = threading.Lock()
+
+    def start(self):
+        """ Start the replenish queue worker and the scheduled sweep """
+        threading.Thread(target=self.process_replenish_queue, name="quiz-replenish", daemon=True).start()
+
+        # Initialize scheduler to periodically reconcile any quizzes missed by the replenish queue
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(self.generate_quizzes, 'interval', minutes=app.config["QUIZ_SWEEP_MINUTES"],
+                          max_instances=1, coalesce=True)
+        scheduler.start()
 
     @staticmethod
     def process_quiz(quiz_text):
         """ Process quiz text and return quiz data """
-        questions = []
-        pattern = re.compile(
-            r'QUESTION: (.+?)\n(?:OPTION A: (.+?)\n)+(?:OPTION B: (.+?)\n)+(?:OPTION C: (.+?)\n)+(?:OPTION D: (.+?)\n)+ANS: (.+?)',
-            re.DOTALL)
-        matches = pattern.findall(quiz_text)
-
-        for match in matches:
-            question = match[0].strip()
-            options = match[1].strip(), match[2].strip(), match[3].strip(), match[4].strip()
-            correct_ans = match[-1].strip()
-
-            question_data = {
-                "question": question,
-                "options": options,
-                "correct_answer": correct_ans
-            }
-            questions.append(question_data)
-
-        return questions
+        parsed = parse_quiz(quiz_text)
+        if parsed['errors']:
+            app.logger.info("Rejected parts of generated quiz: %s", "; ".join(parsed['errors']))
+        return parsed['questions']
 
     @staticmethod
     def store_quiz(topic, questions, user_id):
@@ -97,20 +261,121 @@ class QuizManager:
         quiz = {'user_id': user_id, 'complete': False, 'selected_answers': [], 'topic': topic, 'questions': questions, 'score': 0}
         mongo.db.quizzes.insert_one(quiz)
 
+    def generate_quiz(self, topic, user_id):
+        """ Generate and store a single quiz for a user """
+        try:
+            with self.model_slots:
+                quiz_text = self.model.generate_quiz(topic)
+            self.store_quiz(topic, self.process_quiz(quiz_text), user_id)
+            return user_id
+        except Exception:
+            app.logger.exception("Failed to generate quiz for user %s", user_id)
+            raise
+        finally:
+            with self.in_flight_lock:
+                self.in_flight[user_id] -= 1
+                if self.in_flight[user_id] <= 0:
+                    del self.in_flight[user_id]
+
+    def queue_quizzes(self, user):
+        """ Queue generation of the quizzes a user is missing, and return the futures """
+        with self.in_flight_lock:
+            missing = max(user['deficit'] - self.in_flight[user['_id']], 0)
+            self.in_flight[user['_id']] += missing
+        # Generate each quiz for a random interest
+        return [self.executor.submit(self.generate_quiz, random.choice(user['interests']), user['_id'])
+                for _ in range(missing)]
+
+    def request_replenish(self, user_id):
+        """ Queue a user to have their quizzes replenished """
+        with self.queued_users_lock:
+            if user_id in self.queued_users:
+                return
+            self.queued_users.add(user_id)
+        self.replenish_queue.put(user_id)
+
+    def process_replenish_queue(self):
+        """ Generate the missing quizzes for each user taken from the replenish queue """
+        while True:
+            user_id = self.replenish_queue.get()
+            # Remove the user before planning so any change made from here on queues them again
+            with self.queued_users_lock:
+                self.queued_users.discard(user_id)
+            try:
+                for user in self.plan_deficits(user_id):
+                    self.queue_quizzes(user)
+            except Exception:
+                app.logger.exception("Failed to replenish quizzes for user %s", user_id)
+
+    def plan_deficits(self, user_id=None):
+        """ Find the users that are missing quizzes, and how many each is missing, in a single aggregation """
+        # Skip users with no interests, optionally limited to a single user. Matching on the type of the interests
+        # (rather than on the array being non-empty) lets the interests index skip users without any
+        match = {"interests": {"$type": "string"}}
+        if user_id is not None:
+            match["_id"] = user_id
+        pipeline = [
+            # Only load the fields needed for generation
+            {"$match": match},
+            {"$project": {"interests": 1}},
+            # Count each user's incomplete quizzes on the server, so neither their completed quizzes nor any questions
+            # are read
+            {"$lookup": {
+                "from": "quizzes",
+                "let": {"uid": "$_id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$and": [{"$eq": ["$user_id", "$$uid"]}, {"$eq": ["$complete", False]}]}}},
+                    {"$count": "n"}
+                ],
+                "as": "incomplete"
+            }},
+            {"$project": {
+                "interests": 1,
+                "deficit": {"$subtract": [self.quizzes_per_user,
+                                          {"$ifNull": [{"$arrayElemAt": ["$incomplete.n", 0]}, 0]}]}
+            }},
+            # Only return users that need quizzes
+            {"$match": {"deficit": {"$gt": 0}}}
+        ]
+        return mongo.db.users.aggregate(pipeline)
+
     def generate_quizzes(self):
         """ Generate quizzes for users """
-        users = mongo.db.users.find()
-        for user in users:
-            # Skip users with no interests
-            if not user['interests']:
-                continue
-            incomplete_quizzes = mongo.db.quizzes.count_documents({"user_id": user['_id'], "complete": False})
-            while incomplete_quizzes < 3:
-                # Generate quiz for random interest
-                topic = random.choice(user['interests'])
-                quiz = self.process_quiz(self.fetch_quiz_from_llama(topic, self.model_adapter))
-                self.store_quiz(topic, quiz, user['_id'])
-                incomplete_quizzes += 1
+        # Skip this run if the previous one is still in progress
+        if not self.generation_lock.acquire(blocking=False):
+            app.logger.warning("Previous quiz generation run is still in progress, skipping")
+            return
+        try:
+            start_time = time.monotonic()
+
+            # Queue a generation task for every quiz each user is missing
+            futures = []
+            for user in self.plan_deficits():
+                futures.extend(self.queue_quizzes(user))
+
+            # Wait for the run to finish and record its throughput
+            quizzes_generated = 0
+            users_covered = set()
+            for future in as_completed(futures):
+                # Failures are logged by generate_quiz
+                if future.exception() is None:
+                    users_covered.add(future.result())
+                    quizzes_generated += 1
+
+            elapsed = time.monotonic() - start_time
+            self.last_run_stats = {
+                "quizzes_generated": quizzes_generated,
+                "failed": len(futures) - quizzes_generated,
+                "users_covered": len(users_covered),
+                "seconds": elapsed,
+                "quizzes_per_second": quizzes_generated / elapsed if elapsed > 0 else 0.0
+            }
+            if futures:
+                app.logger.info("Generated %d quizzes for %d users in %.1fs (%.2f quizzes/sec, %d failed)",
+                                quizzes_generated, len(users_covered), elapsed,
+                                self.last_run_stats["quizzes_per_second"], self.last_run_stats["failed"])
+        finally:
+            self.generation_lock.release()
 
 
 class Register(Resource):
@@ -127,21 +392,22 @@ class Register(Resource):
         if not data.get('username') or not data.get('password') or not data.get('email') or not data.get('phone_number'):
             return {"msg": "Missing required fields"}, 400
 
-        # Check if user already exists
-        existing_user = mongo.db.users.find_one({'$or': [{'username': data['username']}, {'email': data['email']}]})
-        if existing_user:
+        # Hash password and store user in database, the unique indexes reject a username or email already in use
+        try:
+            hashed_password = password_hasher.hash(data['password'])
+        except HasherBusy as e:
+            return {"msg": str(e)}, 503, {"Retry-After": "1"}
+        try:
+            result = mongo.db.users.insert_one({
+                'username': data['username'],
+                'password': hashed_password,
+                'email': data['email'],
+                'phone_number': data['phone_number'],
+                'interests': []
+            })
+        except DuplicateKeyError:
             return {"msg": "A user with this username or email already exists"}, 400
 
-        # Hash password and store user in database
-        hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
-        result = mongo.db.users.insert_one({
-            'username': data['username'],
-            'password': hashed_password,
-            'email': data['email'],
-            'phone_number': data['phone_number'],
-            'interests': []
-        })
-
         # Generate access token and return response
         access_token = create_access_token(identity=str(result.inserted_id))
         return {"msg": "User registered successfully", "access_token": access_token,
@@ -162,7 +428,13 @@ class Login(Resource):
 
         # Check if user exists and password is correct
         user = mongo.db.users.find_one({'username': data['username']})
-        if user and bcrypt.check_password_hash(user['password'], data['password']):
+        try:
+            password_correct = user is not None and password_hasher.check(user['password'], data['password'])
+        except HasherBusy as e:
+            return {"msg": str(e)}, 503, {"Retry-After": "1"}
+        if password_correct:
+            # Rehash the password if it was stored at an outdated cost
+            password_hasher.upgrade(mongo.db.users, user, data['password'])
             # Generate access token and return response
             access_token = create_access_token(identity=str(user['_id']))
             return {"msg": "Login successful", "access_token": access_token,
@@ -180,11 +452,6 @@ class UserInterests(Resource):
         # Get current user
         current_user = get_jwt_identity()
         user_id = ObjectId(current_user)
-        # Get user from database
-        user = mongo.db.users.find_one({'_id': user_id})
-        # Check if user exists and return error if not
-        if user is None:
-            return {'msg': 'User not found'}, 404
 
         # Get request data
         data = request.get_json()
@@ -196,8 +463,13 @@ class UserInterests(Resource):
         if not isinstance(interests, list):
             return {'msg': "'interests' field must be a list"}, 400
 
-        # Update user interests in database and return response
-        mongo.db.users.update_one({'_id': user_id}, {'$set': {'interests': interests}})
+        # Update user interests in database, returning error if the user doesn't exist
+        result = mongo.db.users.update_one({'_id': user_id}, {'$set': {'interests': interests}})
+        if result.matched_count == 0:
+            return {'msg': 'User not found'}, 404
+
+        # Generate any quizzes the user is now missing and return response
+        quiz_manager.request_replenish(user_id)
         return {'msg': "Interests updated successfully"}, 200
 
 
@@ -231,20 +503,73 @@ class Interests(Resource):
 
 
 class Quizzes(Resource):
+    # Quiz fields that can be requested with the 'fields' parameter
+    selectable_fields = {'topic', 'complete', 'score', 'questions', 'selected_answers'}
+
     @jwt_required()
     def get(self):
-        """ Handle GET request to fetch all quizzes for the logged-in user """
+        """
+        Handle GET request to fetch quizzes for the logged-in user, optionally filtered with 'complete', paged with
+        'after' and 'limit', and limited to the given 'fields'
+        """
         # Get current user
         current_user = get_jwt_identity()
         user_id = ObjectId(current_user)
-        # Fetch quizzes from database
-        quizzes = mongo.db.quizzes.find({"user_id": user_id})
+        query = {"user_id": user_id}
+
+        # Filter on whether the quiz is complete
+        complete = request.args.get('complete')
+        if complete is not None:
+            if complete not in ('true', 'false'):
+                return {"msg": "'complete' must be true or false"}, 400
+            query['complete'] = complete == 'true'
+
+        # Continue from the last quiz of the previous page
+        after = request.args.get('after')
+        if after is not None:
+            try:
+                query['_id'] = {'$gt': ObjectId(after)}
+            except InvalidId:
+                return {"msg": "'after' must be a quiz id"}, 400
+
+        limit = request.args.get('limit')
+        if limit is not None:
+            max_limit = app.config["QUIZ_PAGE_MAX_LIMIT"]
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if not 0 < limit <= max_limit:
+                return {"msg": f"'limit' must be an integer from 1 to {max_limit}"}, 400
+
+        # Only fetch the requested fields, otherwise everything
+        fields = request.args.get('fields')
+        projection = None
+        if fields is not None:
+            fields = set(fields.split(','))
+            if not fields <= self.selectable_fields:
+                return {"msg": f"'fields' must be a comma separated list of {sorted(self.selectable_fields)}"}, 400
+            projection = dict.fromkeys(fields, 1)
+
+        # Fetch quizzes from database, in id order so the last id can be used as the cursor for the next page
+        quizzes = mongo.db.quizzes.find(query, projection).sort('_id', 1)
+        if limit is not None:
+            quizzes = quizzes.limit(limit)
+
         # Convert quizzes to a list (including the quiz id) and return
         quizzes_list = []
         for quiz in quizzes:
-            quiz_dict = {**quiz, "quiz_id": str(quiz["_id"]), "user_id": str(quiz["user_id"]), "_id": None}
-            quizzes_list.append(quiz_dict)
-        return {"quizzes": quizzes_list}, 200
+            quiz['quiz_id'] = str(quiz['_id'])
+            quiz['_id'] = None
+            if 'user_id' in quiz:
+                quiz['user_id'] = str(quiz['user_id'])
+            quizzes_list.append(quiz)
+
+        response = {"quizzes": quizzes_list}
+        if limit is not None:
+            # A full page means there may be more quizzes to fetch
+            response['next'] = quizzes_list[-1]['quiz_id'] if len(quizzes_list) == limit else None
+        return response, 200
 
     @jwt_required()
     def put(self):
@@ -256,28 +581,131 @@ class Quizzes(Resource):
         # Check if 'quiz_id' and 'selected_answers' fields are present
         if not data.get('quiz_id') or not data.get('selected_answers'):
             return {"msg": "Missing required fields"}, 400
+        selected_answers = data['selected_answers']
+        if not isinstance(selected_answers, list):
+            return {"msg": "'selected_answers' field must be a list"}, 400
 
         user_id = ObjectId(current_user)
         quiz_id = ObjectId(data['quiz_id'])
-        # Fetch the quiz from the database
-        quiz = mongo.db.quizzes.find_one({"_id": quiz_id, "user_id": user_id})
-        if not quiz:
-            return {"msg": "Quiz not found"}, 404
-
-        # Calculate the score
-        score = 0
-        for question, selected_answer in zip(quiz['questions'], data['selected_answers']):
-            if question['correct_answer'] == selected_answer:
-                score += 1
-
-        # Update quiz in database
-        mongo.db.quizzes.update_one(
-            {"_id": quiz_id, "user_id": user_id},
-            {"$set": {"selected_answers": data['selected_answers'], "complete": True, "score": score}}
+        # Score and complete the quiz in a single update, which only matches the quiz until it is completed so a
+        # repeated submission can't change it
+        result = mongo.db.quizzes.update_one(
+            {"_id": quiz_id, "user_id": user_id, "complete": False},
+            [{"$set": {"selected_answers": {"$literal": selected_answers}, "complete": True,
+                       "score": score_expression(selected_answers)}}]
         )
+        if result.matched_count == 0:
+            return already_completed(quiz_id, user_id, selected_answers)
+
+        # Replace the completed quiz
+        quiz_manager.request_replenish(user_id)
         return {"msg": "Quiz updated successfully"}, 200
 
 
+def score_expression(selected_answers):
+    """ Aggregation expression counting the questions answered correctly, for the database to score a quiz with """
+    return {"$add": [{"$cond": [{"$eq": [{"$arrayElemAt": ["$questions.correct_answer", index]},
+                                         {"$literal": selected_answer}]}, 1, 0]}
+                     for index, selected_answer in enumerate(selected_answers)]}
+
+
+def already_completed(quiz_id, user_id, selected_answers):
+    """
+    Response to submitting answers to a quiz that wasn't updated, as it doesn't exist or has been completed. Repeating
+    the submission that completed it succeeds without changing anything, while different answers are refused
+    """
+    quiz = mongo.db.quizzes.find_one({"_id": quiz_id, "user_id": user_id}, {"selected_answers": 1})
+    if quiz is None:
+        return {"msg": "Quiz not found"}, 404
+    if quiz['selected_answers'] != selected_answers:
+        return {"msg": "Quiz already completed"}, 409
+    return {"msg": "Quiz updated successfully"}, 200
+
+
+def ensure_indexes():
+    """
+    Create any missing indexes from the index manifest. Startup fails without the unique indexes on users, as
+    registering relies on them alone to reject a username or email that is already taken
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            mongo.db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # Existing data (e.g. duplicate usernames) can stop an index being built. The app still works without the
+            # others, but not without those on users
+            app.logger.error("Failed to create indexes for %s: %s", collection, e)
+            if collection == "users":
+                raise
+
+
+
+def find_collection_scans(explain):
+    """ Return the stages of the winning plans in an explain result that scan a whole collection """
+    scans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                scans.extend(find_plan_stages(value, 'COLLSCAN'))
+            else:
+                scans.extend(find_collection_scans(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            scans.extend(find_collection_scans(value))
+    return scans
+
+
+def find_plan_stages(plan, stage):
+    """ Return every stage of the given type in a query plan """
+    stages = []
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            stages.append(plan)
+        for value in plan.values():
+            stages.extend(find_plan_stages(value, stage))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_plan_stages(value, stage))
+    return stages
+
+
+@app.cli.command("audit-indexes")
+def audit_indexes():
+    """ Explain every query shape the app makes and fail if any of them scans a whole collection """
+    # Every find, update and aggregation made while serving requests and generating quizzes, as the equivalent
+    # find or aggregation. The count of incomplete quizzes in the deficit planner's lookup is included as a find, as
+    # explain doesn't report the plans of lookup sub-pipelines
+    user_id = ObjectId()
+    finds = [
+        ("users", {'username': "username"}, None),
+        ("users", {'_id': user_id}, None),
+        ("quizzes", {"user_id": user_id}, [('_id', 1)]),
+        ("quizzes", {"user_id": user_id, "complete": False, "_id": {'$gt': ObjectId()}}, [('_id', 1)]),
+        ("quizzes", {"_id": ObjectId(), "user_id": user_id}, None),
+        ("quizzes", {"user_id": user_id, "complete": False}, None)
+    ]
+    aggregations = [
+        ("users", [{"$match": {"interests": {"$type": "string"}}}, {"$project": {"interests": 1}}]),
+        ("users", [{"$match": {"interests": {"$type": "string"}, "_id": user_id}}, {"$project": {"interests": 1}}])
+    ]
+
+    failures = 0
+    for collection, query, sort in finds:
+        cursor = mongo.db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        scans = find_collection_scans(cursor.explain())
+        failures += bool(scans)
+        click.echo(f"{'COLLSCAN' if scans else 'ok':8} {collection}.find({query})")
+    for collection, pipeline in aggregations:
+        scans = find_collection_scans(mongo.db.command('aggregate', collection, pipeline=pipeline, explain=True))
+        failures += bool(scans)
+        click.echo(f"{'COLLSCAN' if scans else 'ok':8} {collection}.aggregate({pipeline})")
+
+    if failures:
+        click.echo(f"{failures} queries scan a whole collection")
+        raise SystemExit(1)
+
+
 # Add resources to API
 api.add_resource(Register, '/register')
 api.add_resource(Login, '/login')
@@ -285,4 +713,19 @@ api.add_resource(UserInterests, '/userinterests')
 api.add_resource(Interests, '/interests')
 api.add_resource(Quizzes, '/quizzes')
 
-QuizManager()
+ensure_indexes()
+
+quiz_manager = QuizManager(create_quiz_model(app.config["QUIZ_MODEL"]))
+
+
+def start_background_work():
+    """
+    Start generating quizzes in the background. Called by the servers (serve.py, or running app.py directly) rather
+    than on import, so CLI commands don't start generating quizzes alongside them
+    """
+    quiz_manager.start()
+
+
+if __name__ == "__main__":
+    start_background_work()
+    app.run()
@@ -1,18 +1,30 @@
-﻿import json
+﻿import click
+import hashlib
+import json
 import os
-import re
 import requests
-from flask import Flask, request, render_template, Response
+from flask import Flask, request, render_template, Response, stream_with_context
 from flask_restful import Resource, Api
 from flask_pymongo import PyMongo
 from flask_bcrypt import Bcrypt
 from dotenv import load_dotenv
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token
+from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
 from gradientai import Gradient
-from datetime import datetime
+from datetime import datetime, timedelta
 from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from apscheduler.schedulers.background import BackgroundScheduler
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from requests.adapters import HTTPAdapter
+from parsing import StoryParser, parse_story
+from passwords import HasherBusy, PasswordHasher, tune_rounds
 import random
+import threading
+import time
 
 # Load environment variables
 load_dotenv()
@@ -21,18 +33,249 @@ load_dotenv()
 app = Flask(__name__)
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
 app.config["MONGO_URI"] = os.getenv("MONGO_URI")
+# bcrypt cost of password hashes, tuned at startup to take about BCRYPT_TARGET_MS milliseconds per hash (but at least
+# 12) unless set. Stored hashes made at a lower cost are rehashed when their user next logs in
+app.config["BCRYPT_TARGET_MS"] = float(os.getenv("BCRYPT_TARGET_MS", 250))
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS") or tune_rounds(app.config["BCRYPT_TARGET_MS"]))
+# Threads hashing passwords, and how many more hashes can wait for one before sign ins are refused with 503
+app.config["PASSWORD_WORKERS"] = int(os.getenv("PASSWORD_WORKERS", 2))
+app.config["PASSWORD_QUEUE"] = int(os.getenv("PASSWORD_QUEUE", 16))
+# Comma separated base URLs of the llama.cpp servers, the number of requests each can serve at once, the timeout for
+# a single request and how often the servers are health checked (both in seconds)
+app.config["LLAMA_ENDPOINTS"] = os.getenv("LLAMA_ENDPOINTS", "http://localhost:8080").split(",")
+app.config["LLAMA_MAX_IN_FLIGHT"] = int(os.getenv("LLAMA_MAX_IN_FLIGHT", 4))
+app.config["LLAMA_TIMEOUT"] = float(os.getenv("LLAMA_TIMEOUT", 120))
+app.config["LLAMA_HEALTH_INTERVAL"] = int(os.getenv("LLAMA_HEALTH_INTERVAL", 15))
+# Consecutive requests to a server that must fail to connect before it is taken out of rotation until its next health check
+app.config["LLAMA_MAX_FAILURES"] = int(os.getenv("LLAMA_MAX_FAILURES", 3))
+# Number of slots (--parallel) on each llama.cpp server. Each request is pinned to a free slot, the one that last served
+# its story if possible so the story's prompt is reused from its cache. 0 leaves the server to pick a slot
+app.config["LLAMA_SLOTS"] = int(os.getenv("LLAMA_SLOTS", 0))
+# Story generation attempts launched at once, whether to launch one more (once per request) when they are slower than
+# the p95 latency, the most attempts per request including those replacing failed ones, the overall deadline in seconds, and the threads used to run attempts
+app.config["STORY_HEDGE_DEPTH"] = int(os.getenv("STORY_HEDGE_DEPTH", 1))
+app.config["STORY_HEDGE_ON_P95"] = os.getenv("STORY_HEDGE_ON_P95", "true").lower() == "true"
+app.config["STORY_MAX_ATTEMPTS"] = int(os.getenv("STORY_MAX_ATTEMPTS", 10))
+app.config["STORY_DEADLINE"] = float(os.getenv("STORY_DEADLINE", 120))
+app.config["STORY_WORKERS"] = int(os.getenv("STORY_WORKERS", 16))
+# Estimated tokens of story allowed in a prompt before older paragraphs are summarised, the number of most recent
+# paragraphs always kept verbatim, how many story summaries are kept and the threads used to write them
+app.config["STORY_CONTEXT_TOKENS"] = int(os.getenv("STORY_CONTEXT_TOKENS", 1500))
+app.config["STORY_RECENT_PARAGRAPHS"] = int(os.getenv("STORY_RECENT_PARAGRAPHS", 6))
+app.config["STORY_SUMMARY_CACHE_SIZE"] = int(os.getenv("STORY_SUMMARY_CACHE_SIZE", 1024))
+app.config["STORY_SUMMARY_WORKERS"] = int(os.getenv("STORY_SUMMARY_WORKERS", 2))
+# Pre-generated openings kept for each recently used world, how many of the most recently used worlds are kept topped
+# up, how long a world (and its openings) is kept after it was last used, and the threads used to generate openings
+app.config["STORY_OPENING_DEPTH"] = int(os.getenv("STORY_OPENING_DEPTH", 2))
+app.config["STORY_OPENING_WORLDS"] = int(os.getenv("STORY_OPENING_WORLDS", 50))
+app.config["STORY_OPENING_TTL_HOURS"] = int(os.getenv("STORY_OPENING_TTL_HOURS", 24))
+app.config["STORY_OPENING_WORKERS"] = int(os.getenv("STORY_OPENING_WORKERS", 2))
+# Whether local completions are constrained by a grammar so they always match the expected format
+app.config["LLAMA_USE_GRAMMAR"] = os.getenv("LLAMA_USE_GRAMMAR", "true").lower() == "true"
 
 # Initialize Flask extensions
 mongo = PyMongo(app)
 bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 api = Api(app)
+password_hasher = PasswordHasher(bcrypt, app.config["BCRYPT_LOG_ROUNDS"], app.config["PASSWORD_WORKERS"],
+                                 app.config["PASSWORD_QUEUE"])
+
+# Indexes for every query the app makes, created at startup
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True)
+    ],
+    # Each part of a story is stored once at its position, so two requests can't both continue from the same part
+    "story_segments": [IndexModel([("story_id", ASCENDING), ("index", ASCENDING)], unique=True)],
+    "story_openings": [
+        IndexModel([("world_key", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("created", ASCENDING)])
+    ],
+    "story_worlds": [IndexModel([("last_used", ASCENDING)])]
+}
+
+
+# GBNF grammar for the story format, one or more paragraphs followed by one to three options
+STORY_GRAMMAR = r'''
+root      ::= "STORY: " paragraph ("\n\n" paragraph)* "\n" options
+paragraph ::= [^\n]+
+options   ::= "OPTION_A: " line ("\n" "OPTION_B: " line ("\n" "OPTION_C: " line)?)?
+line      ::= [^\n]+
+'''
+
+
+class Metrics:
+    """
+    Thread safe counters, reported by the metrics endpoint
+    """
+
+    def __init__(self):
+        """ Initialise Metrics """
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        """ Increment a counter """
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        """ Get the current value of every counter """
+        with self.lock:
+            return dict(self.counters)
+
+
+class NoEndpointAvailable(Exception):
+    """ Raised when no completion endpoint can take a request """
+    pass
+
+
+class CompletionEndpoint:
+    """
+    A llama.cpp server, with a persistent connection pool, a count of the requests it is serving and which of its slots
+    they are pinned to
+    """
+
+    def __init__(self, url, max_in_flight, slots):
+        """ Initialise CompletionEndpoint """
+        self.url = url.rstrip("/")
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.healthy = True
+        # Requests that failed to connect since the last one that didn't
+        self.failures = 0
+        # The story whose prompt each slot last evaluated (None if none), when it was last used, and the slots serving
+        # a request
+        self.slot_owners = [None] * slots
+        self.slot_used = [0.0] * slots
+        self.busy_slots = set()
+        # Keep-alive connections, enough for every request the endpoint can serve at once
+        self.session = requests.Session()
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight))
+
+
+class EndpointPool:
+    """
+    Pool of llama.cpp servers, sending each request to the least loaded healthy server
+    """
+
+    def __init__(self, urls, max_in_flight, timeout, slots=0, max_failures=3):
+        """ Initialise EndpointPool """
+        self.endpoints = [CompletionEndpoint(url, max_in_flight, slots) for url in urls]
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def affinity_score(affinity, endpoint):
+        """ Score an endpoint for an affinity key, the highest scoring healthy endpoint is preferred for the key """
+        return hashlib.sha1(f"{affinity}{endpoint.url}".encode('utf-8')).digest()
+
+    def acquire(self, affinity=None):
+        """
+        Wait for the least loaded healthy endpoint with capacity, and reserve a request and a slot (if it has a free one)
+        on it, returning both. Requests with an affinity key go to the same endpoint while it is healthy and has
+        capacity, so its prompt cache can be reused
+        """
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while True:
+                healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+                if not healthy:
+                    raise NoEndpointAvailable("No healthy completion endpoints")
+                available = [endpoint for endpoint in healthy if endpoint.in_flight < endpoint.max_in_flight]
+                if available:
+                    endpoint = min(available, key=lambda e: e.in_flight)
+                    if affinity is not None:
+                        preferred = max(healthy, key=lambda e: self.affinity_score(affinity, e))
+                        if preferred in available:
+                            endpoint = preferred
+                    endpoint.in_flight += 1
+                    return endpoint, self.take_slot(endpoint, affinity)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NoEndpointAvailable("All completion endpoints are busy")
+                self.condition.wait(remaining)
+
+    @staticmethod
+    def take_slot(endpoint, affinity):
+        """
+        Take a free slot on an endpoint for a request, or None to leave the server to pick one if they are all busy.
+        Requests with an affinity key take the slot that last served the key while it is free, so its cached prompt is
+        reused, and otherwise (like requests without one) the free slot that has been idle the longest, preferring any
+        that isn't holding a story's prompt
+        """
+        free = [slot for slot in range(len(endpoint.slot_owners)) if slot not in endpoint.busy_slots]
+        if not free:
+            return None
+        slot = min(free, key=lambda s: (endpoint.slot_owners[s] != affinity, endpoint.slot_owners[s] is not None,
+                                        endpoint.slot_used[s]))
+        endpoint.busy_slots.add(slot)
+        endpoint.slot_owners[slot] = affinity
+        endpoint.slot_used[slot] = time.monotonic()
+        return slot
+
+    def release(self, endpoint, slot=None, failed=False):
+        """
+        Release a request and its slot reserved on an endpoint, taking the endpoint out of rotation once too many
+        requests in a row could not reach it
+        """
+        with self.condition:
+            endpoint.in_flight -= 1
+            endpoint.busy_slots.discard(slot)
+            endpoint.failures = endpoint.failures + 1 if failed else 0
+            if endpoint.failures >= self.max_failures and endpoint.healthy:
+                app.logger.warning("Completion endpoint %s is now unhealthy", endpoint.url)
+                endpoint.healthy = False
+            self.condition.notify_all()
+
+    def post(self, path, body, stream=False, affinity=None):
+        """
+        Send a request to the least loaded endpoint, pinned to the slot taken for it, returning the endpoint and slot
+        (to release) and the response
+        """
+        endpoint, slot = self.acquire(affinity)
+        if slot is not None:
+            body = {**body, "id_slot": slot}
+        try:
+            response = endpoint.session.post(f"{endpoint.url}{path}", json=body, stream=stream, timeout=self.timeout)
+        except requests.ConnectionError:
+            self.release(endpoint, slot, failed=True)
+            raise
+        except Exception:
+            self.release(endpoint, slot)
+            raise
+        if not response.ok:
+            # Close the response so a streamed one gives its connection back to the pool
+            response.close()
+            self.release(endpoint, slot)
+            response.raise_for_status()
+        return endpoint, slot, response
+
+    def check_health(self):
+        """ Check every endpoint, putting recovered servers back into rotation and taking dead ones out """
+        for endpoint in self.endpoints:
+            try:
+                healthy = endpoint.session.get(f"{endpoint.url}/health", timeout=5).status_code == 200
+            except requests.RequestException:
+                healthy = False
+            if healthy != endpoint.healthy:
+                app.logger.warning("Completion endpoint %s is now %s", endpoint.url, "healthy" if healthy else "unhealthy")
+            with self.condition:
+                endpoint.healthy = healthy
+                if healthy:
+                    endpoint.failures = 0
+                self.condition.notify_all()
 
 
 class AbstractGenerator(ABC):
     """
     Abstract class for story generation
     """
+    # Name of the generator, used in metrics
+    name = None
 
     @abstractmethod
     def generate_story_beginning(self, world):
@@ -40,35 +283,46 @@ class AbstractGenerator(ABC):
         pass
 
     @abstractmethod
-    def generate_next_part(self, world, story, user_selection):
-        """ Generate next part of the story """
+    def generate_next_part(self, world, story, user_selection, affinity=None):
+        """ Generate next part of the story, with the story's affinity key for generators that pin it to a server """
         pass
 
+    @abstractmethod
+    def generate_summary(self, world, summary, story):
+        """ Generate a summary of the earlier summary (which may be empty) followed by the given part of the story """
+        pass
+
+    def stream_story_beginning(self, world):
+        """ Stream the beginning of the story, as a single chunk unless the generator supports streaming """
+        yield self.generate_story_beginning(world)
+
+    def stream_next_part(self, world, story, user_selection, affinity=None):
+        """ Stream the next part of the story, as a single chunk unless the generator supports streaming """
+        yield self.generate_next_part(world, story, user_selection, affinity)
+
+    @staticmethod
+    def affinity_key(world, story=""):
+        """
+        Key for a story from its world and opening, which stay the same on every turn. Taken from the full story, as
+        its opening is summarised away once the story is compacted
+        """
+        text = json.dumps([world['genre'], world['subgenre'], world['premise'], story[:200]])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
     @staticmethod
     def process_generated_text(generated_text):
         """ Process response from Llama into a dictionary """
-        story_response = dict()
-        story_response["options"] = []
-
-        # Extract story and options from generated text
-        pattern = re.compile(r"(?<=STORY:)(.*?)(?=OPTION_A:)|(OPTION_A:.*?)(?=OPTION_B:)|(OPTION_B:.*?)(?=OPTION_C:)|(OPTION_C:.*)",
-                             re.DOTALL)
-        matches = pattern.findall(generated_text)
-        for i, match in enumerate(matches):
-            if i == 0:
-                story_response["story"] = match[0].strip()
-            else:
-                option = match[i].split(":")[1].strip()
-                story_response["options"].append(option)
-
-        # Return the processed response
-        return story_response
+        parsed = parse_story(generated_text)
+        if parsed['errors']:
+            app.logger.info("Malformed generated story: %s", "; ".join(parsed['errors']))
+        return {"story": parsed['story'], "options": parsed['options']}
 
 
 class GradientAIGenerator(AbstractGenerator):
     """
     Class to generate stories using Gradient API
     """
+    name = "gradient"
     model_adapter = None
 
     def __init__(self):
@@ -103,7 +357,7 @@ class GradientAIGenerator(AbstractGenerator):
         response = self.model_adapter.complete(query=query, max_generated_token_count=500).generated_output
         return response
 
-    def generate_next_part(self, world, story, user_selection):
+    def generate_next_part(self, world, story, user_selection, affinity=None):
         """ Generate next part of the story """
         query = (
             f"[INST]\n"
@@ -131,67 +385,124 @@ class GradientAIGenerator(AbstractGenerator):
         response = self.model_adapter.complete(query=query, max_generated_token_count=500).generated_output
         return response
 
+    def generate_summary(self, world, summary, story):
+        """ Generate a summary of the story so far """
+        query = (
+            f"[INST]\n"
+            f"EARLIER_SUMMARY: {summary}\n"
+            f"STORY_CONTINUED: {story}\n"
+            f"GENRE: {world['genre']}\n"
+            f"SUBGENRE: {world['subgenre']}\n"
+            f"PREMISE: {world['premise']}\n"
+            f"INSTRUCTIONS:\n"
+            f"Summarise the story so far, which is the EARLIER_SUMMARY (if any) followed by the STORY_CONTINUED, in one paragraph of at most 150 words.\n"
+            f"Keep the characters, places, objects and unresolved events needed to continue the story.\n"
+            f"Respond with only the summary.\n"
+            f"[/INST]"
+        )
+        response = self.model_adapter.complete(query=query, max_generated_token_count=250).generated_output
+        return response.strip()
+
 
 class LocalAIGenerator(AbstractGenerator):
     """ 
     Class to generate stories using a local Llama 3 8b model with 8 bit quantization (meta-llama-3-8b-instruct-imat-Q8_0.gguf)
     """
+    name = "local"
 
-    def generate_next_part(self, world, story, user_selection):
-        query = (
-            f"<|start_header_id|>system<|end_header_id|>"
-            f"STORY_SO_FAR: {story}\n"
-            f"USER_SELECTED_OPTION: {user_selection}\n"
+    # Instructions shared by every story, at the start of the prompt so the server only evaluates them once
+    system_prompt = (
+        "<|start_header_id|>system<|end_header_id|>"
+        "INSTRUCTIONS:\n"
+        "You are an interactive story generator who generates stories for the end user and provides them with options to continue the story.\n"
+        "Use the GENRE, SUBGENRE, and PREMISE provided below to guide the story generation.\n"
+        "Provide the user with 1 to 3 options to choose from to continue the story, where the first option may be just 'Continue...'.\n"
+        "The user options should not be grandiose or major plot points, but rather small, immediate choices that the user can make.\n"
+        "Keep the generated options brief and to the point. Format your response EXACTLY as follows:\n"
+        "STORY: [generated story text]\n"
+        "OPTION_A: [generated option A]\n"
+        "OPTION_B: [generated option B]\n"
+        "OPTION_C: [generated option C]\n"
+    )
+
+    def __init__(self, endpoint_pool):
+        """ Initialise LocalAIGenerator """
+        self.endpoint_pool = endpoint_pool
+
+    def generate_next_part(self, world, story, user_selection, affinity=None):
+        return self.query_model(self.next_part_query(world, story, user_selection), self.story_grammar(),
+                                affinity or self.affinity_key(world, story))
+
+    def generate_story_beginning(self, world):
+        return self.query_model(self.story_beginning_query(world), self.story_grammar(), self.affinity_key(world))
+
+    def stream_next_part(self, world, story, user_selection, affinity=None):
+        return self.stream_model(self.next_part_query(world, story, user_selection), self.story_grammar(),
+                                 affinity or self.affinity_key(world, story))
+
+    def stream_story_beginning(self, world):
+        return self.stream_model(self.story_beginning_query(world), self.story_grammar(), self.affinity_key(world))
+
+    def generate_summary(self, world, summary, story):
+        # Without the story's affinity key, so summarising doesn't evict the story's cached prompt from its slot
+        return self.query_model(self.summary_query(world, summary, story)).strip()
+
+    @staticmethod
+    def world_prompt(world):
+        """ Build the part of the prompt describing the world """
+        return (
             f"GENRE: {world['genre']}\n"
             f"SUBGENRE: {world['subgenre']}\n"
             f"PREMISE: {world['premise']}\n"
-            f"INSTRUCTIONS:\n"
-            f"You are an interactive story generator who generates stories for the end user and provides them with options to continue the story.\n"
+        )
+
+    def next_part_query(self, world, story, user_selection):
+        """ Build the prompt for the next part of the story, with the story last as it is the part that grows """
+        return (
+            f"{self.system_prompt}"
+            f"{self.world_prompt(world)}"
             f"You are in the middle of a story.\n"
             f"The user is a character in the story you are creating.\n"
             f"Generate around 1 to 3 more paragraphs of the story from this point using the STORY_SO_FAR and USER_SELECTED_OPTION.\n"
-            f"Use the GENRE, SUBGENRE, and PREMISE provided above to guide the story generation.\n"
             f"Do not include the USER_SELECTED_OPTION in the generated story text.\n"
-            f"Provide the user with 1 to 3 options to choose from to continue the story, where the first option may be just 'Continue...'.\n"
-            f"The user options should not be grandiose or major plot points, but rather small, immediate choices that the user can make.\n"
-            f"Keep the generated options brief and to the point. Format your response EXACTLY as follows:\n"
-            f"STORY: [generated story text]\n"
-            f"OPTION_A: [generated option A]\n"
-            f"OPTION_B: [generated option B]\n"
-            f"OPTION_C: [generated option C]<|eot_id|>\n"
+            f"STORY_SO_FAR: {story}\n"
+            f"USER_SELECTED_OPTION: {user_selection}<|eot_id|>\n"
             f"<|start_header_id|>assistant<|end_header_id|>"
         )
-        return self.query_model(query)
 
-    def generate_story_beginning(self, world):
-        query = (
-            f"<|start_header_id|>system<|end_header_id|>"
-            f"GENRE: {world['genre']}\n"
-            f"SUBGENRE: {world['subgenre']}\n"
-            f"PREMISE: {world['premise']}\n"
-            f"INSTRUCTIONS:\n"
-            f"You are an interactive story generator who generates stories for the end user and provides them with options to continue the story.\n"
+    def story_beginning_query(self, world):
+        """ Build the prompt for the beginning of the story """
+        return (
+            f"{self.system_prompt}"
+            f"{self.world_prompt(world)}"
             f"You are starting a new story.\n"
             f"The user will be a character in the story that you will create.\n"
-            f"Generate around 3 paragraphs to begin the story.\n"
-            f"Use the GENRE, SUBGENRE, and PREMISE provided above to guide the story generation.\n"
-            f"Provide the user with 1 to 3 options to choose from to continue the story, where the first option may be just 'Continue...'.\n"
-            f"The user options should not be grandiose or major plot points, but rather small, immediate choices that the user can make.\n"
-            f"Keep the generated options brief and to the point. Format your response EXACTLY as follows:\n"
-            f"STORY: [generated story text]\n"
-            f"OPTION_A: [generated option A]\n"
-            f"OPTION_B: [generated option B]\n"
-            f"OPTION_C: [generated option C]<|eot_id|>\n"
+            f"Generate around 3 paragraphs to begin the story.<|eot_id|>\n"
+            f"<|start_header_id|>assistant<|end_header_id|>"
+        )
+
+    def summary_query(self, world, summary, story):
+        """ Build the prompt to summarise the story so far """
+        return (
+            f"<|start_header_id|>system<|end_header_id|>"
+            f"INSTRUCTIONS:\n"
+            f"Summarise the story so far, which is the EARLIER_SUMMARY (if any) followed by the STORY_CONTINUED, in one paragraph of at most 150 words.\n"
+            f"Keep the characters, places, objects and unresolved events needed to continue the story.\n"
+            f"Respond with only the summary.\n"
+            f"{self.world_prompt(world)}"
+            f"EARLIER_SUMMARY: {summary}\n"
+            f"STORY_CONTINUED: {story}<|eot_id|>\n"
             f"<|start_header_id|>assistant<|end_header_id|>"
         )
-        return self.query_model(query)
 
     @staticmethod
-    def query_model(query):
-        # query the model using an HTTP POST request to http://localhost:8080/completion
+    def completion_body(query, stream=False, grammar=""):
+        """ Build the request body for the llama.cpp completion endpoint """
         body = {"prompt": query,
+                # Reuse the evaluation of the prompt prefix the slot already has cached
+                "cache_prompt": True,
                 "frequency_penalty": 0,
-                "grammar": "",
+                "grammar": grammar,
                 "min_keep": 0,
                 "min_p": 0.05,
                 "mirostat": 0,
@@ -203,15 +514,339 @@ class LocalAIGenerator(AbstractGenerator):
                 "presence_penalty": 0,
                 "repeat_last_n": 256,
                 "repeat_penalty": 1.18,
-                "stream": False,
+                "stream": stream,
                 "temperature": 0.7,
                 "tfs_z": 1,
                 "top_k": 40,
                 "top_p": 0.95,
                 "typical_p": 1}
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post("http://localhost:8080/completion", data=json.dumps(body), headers=headers)
-        return response.json()['content']
+        return body
+
+    @staticmethod
+    def story_grammar():
+        """ Grammar to constrain story generation with, if enabled """
+        return STORY_GRAMMAR if app.config["LLAMA_USE_GRAMMAR"] else ""
+
+    def query_model(self, query, grammar="", affinity=None):
+        # query the model using an HTTP POST request to the /completion endpoint of the least loaded server, or the
+        # server and slot the story's prompt is cached on
+        body = self.completion_body(query, grammar=grammar)
+        endpoint, slot, response = self.endpoint_pool.post("/completion", body, affinity=affinity)
+        try:
+            return response.json()['content']
+        finally:
+            self.endpoint_pool.release(endpoint, slot)
+
+    def stream_model(self, query, grammar="", affinity=None):
+        """ Query the model in stream mode, yielding the generated text as it arrives """
+        body = self.completion_body(query, stream=True, grammar=grammar)
+        endpoint, slot, response = self.endpoint_pool.post("/completion", body, stream=True, affinity=affinity)
+        yield from self.read_stream(endpoint, slot, response)
+
+    def read_stream(self, endpoint, slot, response):
+        """ Yield the generated text from a streamed completion, then release the endpoint """
+        try:
+            with response:
+                # Each event is a line of the form 'data: {"content": "...", "stop": false, ...}'
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    if event.get('content'):
+                        yield event['content']
+                    if event.get('stop'):
+                        break
+        finally:
+            self.endpoint_pool.release(endpoint, slot)
+
+
+class StoryHedger:
+    """
+    Runs story generation attempts in parallel, returning the first that produces options and abandoning the rest
+    """
+
+    # Number of successful attempt latencies kept, and how many are needed before hedging on the p95
+    latency_window = 200
+    min_latency_samples = 20
+
+    def __init__(self, executor, depth, hedge_on_p95, max_attempts, deadline):
+        """ Initialise StoryHedger """
+        self.executor = executor
+        self.depth = depth
+        self.hedge_on_p95 = hedge_on_p95
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.latencies = deque(maxlen=self.latency_window)
+        self.lock = threading.Lock()
+
+    def p95(self):
+        """ The 95th percentile latency of successful attempts, or None without enough samples """
+        with self.lock:
+            if len(self.latencies) < self.min_latency_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+    def timed_attempt(self, attempt, cancelled):
+        """ Run an attempt, recording its latency if it succeeds """
+        start_time = time.monotonic()
+        response = attempt(cancelled)
+        if response is not None and len(response['options']) > 0:
+            with self.lock:
+                self.latencies.append(time.monotonic() - start_time)
+        return response
+
+    def generate(self, attempt):
+        """
+        Run attempts until one returns options, returning None if none do before the deadline. Each attempt is called
+        with a threading.Event that is set once its result is no longer wanted, when it should stop and return None
+        """
+        start_time = time.monotonic()
+        deadline = start_time + self.deadline
+        # Each running attempt's future, with the order it was launched in and its cancellation event
+        futures = {}
+        attempts = 0
+        hedged = not self.hedge_on_p95
+        error = None
+
+        def launch():
+            nonlocal attempts
+            attempts += 1
+            metrics.increment("story_attempts")
+            cancelled = threading.Event()
+            futures[self.executor.submit(self.timed_attempt, attempt, cancelled)] = (attempts, cancelled)
+
+        def cancel_running():
+            # Attempts that haven't started are never run, and those running stop at their next chunk of output,
+            # closing their connection so the server stops generating and their slot and endpoint are released
+            for future, (_, cancelled) in futures.items():
+                future.cancel()
+                cancelled.set()
+
+        for _ in range(min(self.depth, self.max_attempts)):
+            launch()
+
+        while futures:
+            # Wait for an attempt to finish, or until the attempts started with the request are slower than the p95
+            # and it is time to hedge with one more
+            timeout = deadline - time.monotonic()
+            hedge_time = None
+            if not hedged and attempts < self.max_attempts:
+                p95 = self.p95()
+                if p95 is not None:
+                    hedge_time = start_time + p95
+                    timeout = min(timeout, hedge_time - time.monotonic())
+            done, _ = wait(futures, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                index, _ = futures.pop(future)
+                if future.exception() is None and len(future.result()['options']) > 0:
+                    metrics.increment("story_wins_first_attempt" if index == 1 else "story_wins_later_attempt")
+                    metrics.increment("story_losses", len(futures))
+                    cancel_running()
+                    return future.result()
+                # The attempt failed or generated no options, so replace it
+                metrics.increment("story_failed_attempts")
+                error = future.exception() or error
+                if attempts < self.max_attempts and time.monotonic() < deadline:
+                    launch()
+
+            if time.monotonic() >= deadline:
+                metrics.increment("story_timeouts")
+                cancel_running()
+                break
+            if hedge_time is not None and time.monotonic() >= hedge_time and futures and attempts < self.max_attempts:
+                # The running attempts are slower than the p95, so start another alongside them
+                hedged = True
+                metrics.increment("story_hedges")
+                launch()
+
+        metrics.increment("story_failures")
+        if isinstance(error, NoEndpointAvailable):
+            raise error
+        return None
+
+
+class StoryCompactor:
+    """
+    Keeps the story in prompts within a token budget, by keeping the most recent paragraphs verbatim and replacing the
+    older ones with a summary, which is refreshed in the background whenever the budget is exceeded
+    """
+
+    def __init__(self, executor, budget, recent_paragraphs, size):
+        """ Initialise StoryCompactor """
+        self.executor = executor
+        self.budget = budget
+        self.recent_paragraphs = recent_paragraphs
+        self.size = size
+        # Latest summary of each story, as the number of paragraphs it covers, a hash of them and the summary
+        self.summaries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate_tokens(text):
+        """ Estimate the number of tokens in some text, about 4 characters each for English """
+        return len(text) // 4
+
+    @staticmethod
+    def split_paragraphs(story):
+        """ Split a story into its non-empty paragraphs """
+        return [paragraph.strip() for paragraph in story.split("\n") if paragraph.strip()]
+
+    @staticmethod
+    def story_key(world, paragraphs):
+        """ Key for a story from its world and first paragraph, which stay the same as it grows """
+        text = json.dumps([world['genre'], world['subgenre'], world['premise'], paragraphs[0]])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def paragraphs_hash(paragraphs):
+        """ Hash of the paragraphs a summary covers, to check a story still starts with them """
+        return hashlib.sha1("\n".join(paragraphs).encode('utf-8')).hexdigest()
+
+    def compact(self, generator, world, story):
+        """ Return the story to put in the prompt, starting a summary refresh if it is over the budget """
+        paragraphs = self.split_paragraphs(story)
+        if not paragraphs:
+            return story
+        key = self.story_key(world, paragraphs)
+
+        covered, summary = 0, ""
+        with self.lock:
+            entry = self.summaries.get(key)
+            if entry is not None:
+                self.summaries.move_to_end(key)
+        if entry is not None and entry[0] <= len(paragraphs) and entry[1] == self.paragraphs_hash(paragraphs[:entry[0]]):
+            covered, summary = entry[0], entry[2]
+
+        recent = paragraphs[covered:]
+        if self.estimate_tokens(summary) + sum(self.estimate_tokens(paragraph) for paragraph in recent) > self.budget:
+            self.request_refresh(generator, key, world, paragraphs, covered, summary)
+
+        # Only change the story once part of it has been summarised
+        if covered == 0:
+            return story
+        return "\n\n".join([f"(Summary of the story before this point: {summary})"] + recent)
+
+    def request_refresh(self, generator, key, world, paragraphs, covered, summary):
+        """ Summarise all but the most recent paragraphs in the background, unless it is already being done """
+        end = len(paragraphs) - self.recent_paragraphs
+        if end <= covered:
+            return
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        self.executor.submit(self.refresh, generator, key, world, paragraphs[:end], covered, summary)
+
+    def refresh(self, generator, key, world, paragraphs, covered, summary):
+        """ Fold the paragraphs after those the summary covers into it """
+        try:
+            new_summary = generator.generate_summary(world, summary, "\n\n".join(paragraphs[covered:]))
+            if not new_summary:
+                metrics.increment("story_summary_failures")
+                return
+            with self.lock:
+                self.summaries[key] = (len(paragraphs), self.paragraphs_hash(paragraphs), new_summary)
+                self.summaries.move_to_end(key)
+                while len(self.summaries) > self.size:
+                    self.summaries.popitem(last=False)
+            metrics.increment("story_summaries")
+        except Exception as e:
+            app.logger.error("Failed to summarise story: %s", e)
+            metrics.increment("story_summary_failures")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+
+class OpeningPool:
+    """
+    Keeps a few pre-generated openings for each recently used world (and generator), so starting a story is usually a
+    database read. Each opening is handed out once, and the world is topped up again in the background
+    """
+
+    def __init__(self, executor, generators, depth, max_worlds, ttl):
+        """ Initialise OpeningPool """
+        self.executor = executor
+        self.generators = {generator.name: generator for generator in generators}
+        self.depth = depth
+        self.max_worlds = max_worlds
+        self.ttl = ttl
+        # Worlds with a top up queued or running, so each is only topped up once at a time
+        self.filling = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def world_key(generator, world):
+        """ Key for a world and the generator its openings come from """
+        text = json.dumps([generator.name, world['genre'], world['subgenre'], world['premise']])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def take(self, generator, world):
+        """ Take a pooled opening for a world, or None if there isn't one, and top the world up """
+        key = self.world_key(generator, world)
+        mongo.db.story_worlds.update_one({"_id": key}, {"$set": {
+            "generator": generator.name,
+            "world": {"genre": world['genre'], "subgenre": world['subgenre'], "premise": world['premise']},
+            "last_used": datetime.utcnow()
+        }}, upsert=True)
+        opening = mongo.db.story_openings.find_one_and_delete({"world_key": key}, sort=[("_id", ASCENDING)])
+        self.request_fill(key)
+
+        if opening is None:
+            metrics.increment("story_openings_missed")
+            return None
+        metrics.increment("story_openings_pooled")
+        return {"story": opening['story'], "options": opening['options']}
+
+    def request_fill(self, key):
+        """ Top up a world's openings in the background, unless it is already being topped up """
+        with self.lock:
+            if key in self.filling:
+                return
+            self.filling.add(key)
+        self.executor.submit(self.fill_world, key)
+
+    def fill_world(self, key):
+        """ Generate openings for a world until it has the pool depth """
+        try:
+            world = mongo.db.story_worlds.find_one({"_id": key})
+            if world is None or world['generator'] not in self.generators:
+                return
+            generator = self.generators[world['generator']]
+            # Recount each time, as openings may be taken while this runs
+            for _ in range(self.depth):
+                if mongo.db.story_openings.count_documents({"world_key": key}) >= self.depth:
+                    break
+                response = generator.process_generated_text(generator.generate_story_beginning(world['world']))
+                record_parse(generator, response)
+                # Openings the model didn't format properly are dropped, the next fill tries again
+                if len(response['options']) == 0:
+                    continue
+                mongo.db.story_openings.insert_one({
+                    "world_key": key,
+                    "story": response['story'],
+                    "options": response['options'],
+                    "created": datetime.utcnow()
+                })
+                metrics.increment("story_openings_generated")
+        except Exception as e:
+            app.logger.error("Failed to generate openings: %s", e)
+        finally:
+            with self.lock:
+                self.filling.discard(key)
+
+    def fill(self):
+        """ Forget worlds that haven't been used recently, and top up the most recently used ones """
+        cutoff = datetime.utcnow() - self.ttl
+        mongo.db.story_worlds.delete_many({"last_used": {"$lt": cutoff}})
+        mongo.db.story_openings.delete_many({"created": {"$lt": cutoff}})
+
+        worlds = mongo.db.story_worlds.find({}, {"_id": 1}).sort("last_used", -1).limit(self.max_worlds)
+        for world in worlds:
+            self.request_fill(world['_id'])
 
 
 class Register(Resource):
@@ -228,20 +863,21 @@ class Register(Resource):
         if not data.get('username') or not data.get('password') or not data.get('email') or not data.get('phone_number'):
             return {"msg": "Missing required fields"}, 400
 
-        # Check if user already exists
-        existing_user = mongo.db.users.find_one({'$or': [{'username': data['username']}, {'email': data['email']}]})
-        if existing_user:
+        # Hash password and store user in database, the unique indexes reject a username or email already in use
+        try:
+            hashed_password = password_hasher.hash(data['password'])
+        except HasherBusy as e:
+            return {"msg": str(e)}, 503, {"Retry-After": "1"}
+        try:
+            result = mongo.db.users.insert_one({
+                'username': data['username'],
+                'password': hashed_password,
+                'email': data['email'],
+                'phone_number': data['phone_number']
+            })
+        except DuplicateKeyError:
             return {"msg": "A user with this username or email already exists"}, 400
 
-        # Hash password and store user in database
-        hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
-        result = mongo.db.users.insert_one({
-            'username': data['username'],
-            'password': hashed_password,
-            'email': data['email'],
-            'phone_number': data['phone_number']
-        })
-
         # Generate access token and return response
         access_token = create_access_token(identity=str(result.inserted_id), expires_delta=False)
         return {"msg": "User registered successfully", "access_token": access_token,
@@ -263,7 +899,13 @@ class Login(Resource):
 
         # Check if user exists and password is correct
         user = mongo.db.users.find_one({'username': data['username']})
-        if user and bcrypt.check_password_hash(user['password'], data['password']):
+        try:
+            password_correct = user is not None and password_hasher.check(user['password'], data['password'])
+        except HasherBusy as e:
+            return {"msg": str(e)}, 503, {"Retry-After": "1"}
+        if password_correct:
+            # Rehash the password if it was stored at an outdated cost
+            password_hasher.upgrade(mongo.db.users, user, data['password'])
             # Generate access token and return response
             access_token = create_access_token(identity=str(user['_id']), expires_delta=False)
             return {"msg": "Login successful", "access_token": access_token,
@@ -276,6 +918,9 @@ class Login(Resource):
 class Story(Resource):
     """ Story resource to handle story generation and continuation """
 
+    # Supported streaming formats, newline delimited JSON or server-sent events
+    stream_mimetypes = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
     @jwt_required()
     def post(self):
         # Get request data
@@ -296,29 +941,411 @@ class Story(Resource):
         # Select generator based on use_local_llm flag
         generator = local_generator if use_local_llm else gradient_generator
 
-        # Generate story, 10 attempts and if no options are generated, return error
-        for i in range(10):
-            print("Generation attempt ", i)
+        # Optionally stream the story text and options as they are generated
+        stream_format = request.args.get('stream')
+        if stream_format in self.stream_mimetypes:
+            return self.stream_response(generator, world, story, user_selection, stream_format)
+
+        # Generate story with hedged attempts, and if no attempt generates options, return error
+        try:
+            response = self.generate(generator, world, story, user_selection)
+        except NoEndpointAvailable as e:
+            return {"msg": str(e)}, 503
+
+        if response is None:
+            return {"msg": "Failed to generate story"}, 500
+
+        return response, 200
+
+    @staticmethod
+    def generate(generator, world, story, user_selection):
+        """ Generate the beginning (for an empty story) or the next part of a story, or None if it fails """
+        if story == "":
+            opening = opening_pool.take(generator, world)
+            if opening is not None:
+                return opening
+        else:
+            affinity = generator.affinity_key(world, story)
+            story = story_compactor.compact(generator, world, story)
+
+        def attempt(cancelled):
+            """ Generate and process one attempt at the story, or None if it is cancelled """
+            # Streamed so the attempt can be stopped part way, as closing the stream closes its connection
             if story == "":
-                generated_text = generator.generate_story_beginning(world)
+                chunks = generator.stream_story_beginning(world)
             else:
-                generated_text = generator.generate_next_part(world, story, user_selection)
+                chunks = generator.stream_next_part(world, story, user_selection, affinity)
+            generated_text = []
+            try:
+                for chunk in chunks:
+                    if cancelled.is_set():
+                        return None
+                    generated_text.append(chunk)
+            finally:
+                chunks.close()
+            if cancelled.is_set():
+                return None
+            response = generator.process_generated_text("".join(generated_text))
+            record_parse(generator, response)
+            return response
 
-            response = generator.process_generated_text(generated_text)
-            if len(response['options']) > 0:
-                break
+        return story_hedger.generate(attempt)
+
+    def stream_response(self, generator, world, story, user_selection, stream_format, save=None):
+        """ Stream the beginning (for an empty story) or the next part of a story """
+        if story == "":
+            opening = opening_pool.take(generator, world)
+            if opening is not None:
+                events = self.stream_opening(opening, stream_format, save)
+                return Response(stream_with_context(events), mimetype=self.stream_mimetypes[stream_format])
+            chunks = generator.stream_story_beginning(world)
+        else:
+            affinity = generator.affinity_key(world, story)
+            story = story_compactor.compact(generator, world, story)
+            chunks = generator.stream_next_part(world, story, user_selection, affinity)
+        events = self.stream_story(generator, chunks, stream_format, save)
+        return Response(stream_with_context(events), mimetype=self.stream_mimetypes[stream_format])
+
+    @staticmethod
+    def format_event(event, data, stream_format):
+        """ Format an event as a line of the stream """
+        if stream_format == 'sse':
+            return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        return json.dumps({"event": event, **data}) + "\n"
+
+    def stream_story(self, generator, chunks, stream_format, save=None):
+        """
+        Yield the story text as it is generated, each option once it is complete, and then the full response. The
+        optional save function stores the response and returns fields to add to it, or None if it couldn't be stored
+        """
+        parser = StoryParser()
+        try:
+            for chunk in chunks:
+                for event, text in parser.feed(chunk):
+                    yield self.format_event(event, {"text": text}, stream_format)
+        except NoEndpointAvailable as e:
+            yield self.format_event("error", {"msg": str(e)}, stream_format)
+            return
+        except requests.RequestException as e:
+            # The response has already started, so the failure can only be reported as an event
+            app.logger.error("Failed to stream story: %s", e)
+            yield self.format_event("error", {"msg": "Failed to generate story"}, stream_format)
+            return
+        for event, text in parser.finish():
+            yield self.format_event(event, {"text": text}, stream_format)
+
+        # Streamed generations can't be retried, so report the failure if no options were generated
+        record_parse(generator, {"options": parser.options})
+        if len(parser.options) == 0:
+            yield self.format_event("error", {"msg": "Failed to generate story"}, stream_format)
+            return
+        yield from self.finish_stream({"story": parser.story, "options": parser.options}, stream_format, save)
+
+    def stream_opening(self, opening, stream_format, save=None):
+        """ Yield the events for a pooled opening, which has already been generated """
+        yield self.format_event("story", {"text": opening['story']}, stream_format)
+        for option in opening['options']:
+            yield self.format_event("option", {"text": option}, stream_format)
+        yield from self.finish_stream(opening, stream_format, save)
 
-        if len(response['options']) == 0:
+    def finish_stream(self, response, stream_format, save=None):
+        """ Save the response if needed, and yield the final event """
+        if save is not None:
+            saved = save(response)
+            if saved is None:
+                yield self.format_event("error", {"msg": STORY_CONFLICT}, stream_format)
+                return
+            response.update(saved)
+        yield self.format_event("done", response, stream_format)
+
+
+class Stories(Resource):
+    """ Stories resource to start a story session, which is then continued by only sending the selected option """
+
+    @jwt_required()
+    def post(self):
+        """ Handle POST request to start a story for a world, generating its beginning """
+        current_user = get_jwt_identity()
+        data = request.get_json()
+
+        # Check if required fields are present
+        if 'world' not in data or 'use_local_llm' not in data:
+            return {"msg": "Missing required fields"}, 400
+
+        world = data['world']
+        if 'genre' not in world or 'subgenre' not in world or 'premise' not in world:
+            return {"msg": "Missing required fields in world"}, 400
+
+        story = {
+            "_id": ObjectId(),
+            "user_id": ObjectId(current_user),
+            "world": {"genre": world['genre'], "subgenre": world['subgenre'], "premise": world['premise']},
+            "use_local_llm": bool(data['use_local_llm']),
+            "options": [],
+            "created": datetime.utcnow()
+        }
+        generator = local_generator if story['use_local_llm'] else gradient_generator
+
+        def save(response):
+            """ Store the story once its beginning has been generated """
+            mongo.db.stories.insert_one(story)
+            return append_segment(story, [], "", response)
+
+        stream_format = request.args.get('stream')
+        if stream_format in Story.stream_mimetypes:
+            return Story().stream_response(generator, story['world'], "", "", stream_format, save)
+
+        try:
+            response = Story.generate(generator, story['world'], "", "")
+        except NoEndpointAvailable as e:
+            return {"msg": str(e)}, 503
+
+        if response is None:
             return {"msg": "Failed to generate story"}, 500
 
-        return response, 200
+        return {**response, **save(response)}, 201
+
+
+class StorySession(Resource):
+    """ StorySession resource to fetch and continue a story stored on the server """
+
+    @jwt_required()
+    def get(self, story_id):
+        """ Handle GET request for the whole story so far, e.g. to resume it """
+        story, segments = find_story(story_id, get_jwt_identity())
+        if story is None:
+            return {"msg": "Story not found"}, 404
+
+        return {"story_id": story_id, "world": story['world'], "use_local_llm": story['use_local_llm'],
+                "story": join_segments(segments), "options": story['options'],
+                "segments": [{"user_selection": segment['user_selection'], "text": segment['text']}
+                             for segment in segments]}, 200
+
+    @jwt_required()
+    def post(self, story_id):
+        """ Handle POST request to continue the story with the option the user selected """
+        data = request.get_json()
+
+        # Check if required fields are present
+        if 'user_selection' not in data:
+            return {"msg": "Missing required fields"}, 400
+
+        story, segments = find_story(story_id, get_jwt_identity())
+        if story is None:
+            return {"msg": "Story not found"}, 404
+
+        generator = local_generator if story['use_local_llm'] else gradient_generator
+        story_so_far = join_segments(segments)
+
+        def save(response):
+            """ Append the generated part to the story """
+            return append_segment(story, segments, data['user_selection'], response)
+
+        stream_format = request.args.get('stream')
+        if stream_format in Story.stream_mimetypes:
+            return Story().stream_response(generator, story['world'], story_so_far, data['user_selection'],
+                                           stream_format, save)
+
+        try:
+            response = Story.generate(generator, story['world'], story_so_far, data['user_selection'])
+        except NoEndpointAvailable as e:
+            return {"msg": str(e)}, 503
+
+        if response is None:
+            return {"msg": "Failed to generate story"}, 500
+
+        saved = save(response)
+        if saved is None:
+            return {"msg": STORY_CONFLICT}, 409
+
+        return {**response, **saved}, 200
+
+
+# Returned when two requests continue a story from the same part and the other one was stored first
+STORY_CONFLICT = "The story has already been continued"
+
+
+def find_story(story_id, user_id):
+    """ Fetch a user's story and its parts in order, or None if it doesn't exist """
+    try:
+        story = mongo.db.stories.find_one({"_id": ObjectId(story_id), "user_id": ObjectId(user_id)})
+    except InvalidId:
+        return None, []
+    if story is None:
+        return None, []
+
+    segments = list(mongo.db.story_segments.find({"story_id": story['_id']},
+                                                 {"_id": 0, "user_selection": 1, "text": 1}).sort("index", 1))
+    return story, segments
+
+
+def join_segments(segments):
+    """ Join the parts of a story into the story so far """
+    return "\n\n".join(segment['text'] for segment in segments)
+
+
+def append_segment(story, segments, user_selection, response):
+    """
+    Store a generated part after the given parts of a story, returning the fields to add to the response, or None if
+    another request has already stored a part there. Parts are never updated, only inserted
+    """
+    index = len(segments)
+    try:
+        mongo.db.story_segments.insert_one({
+            "story_id": story['_id'],
+            "index": index,
+            "user_selection": user_selection,
+            "text": response['story'],
+            "options": response['options'],
+            "created": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        return None
+
+    # Keep the latest options on the story so it can be resumed without fetching the last part's options
+    mongo.db.stories.update_one({"_id": story['_id']},
+                                {"$set": {"options": response['options'], "updated": datetime.utcnow()}})
+    return {"story_id": str(story['_id']), "segment": index}
+
+
+def ensure_indexes():
+    """
+    Create any missing indexes from the index manifest. Startup fails without the unique indexes on users, as
+    registering relies on them alone to reject a username or email that is already taken
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            mongo.db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # Existing data (e.g. duplicate usernames) can stop an index being built. The app still works without the
+            # others, but not without those on users
+            app.logger.error("Failed to create indexes for %s: %s", collection, e)
+            if collection == "users":
+                raise
+
+
+def find_collection_scans(explain):
+    """ Return the stages of the winning plans in an explain result that scan a whole collection """
+    scans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                scans.extend(find_plan_stages(value, 'COLLSCAN'))
+            else:
+                scans.extend(find_collection_scans(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            scans.extend(find_collection_scans(value))
+    return scans
+
+
+def find_plan_stages(plan, stage):
+    """ Return every stage of the given type in a query plan """
+    stages = []
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            stages.append(plan)
+        for value in plan.values():
+            stages.extend(find_plan_stages(value, stage))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_plan_stages(value, stage))
+    return stages
+
+
+@app.cli.command("audit-indexes")
+def audit_indexes():
+    """ Explain every query shape the app makes and fail if any of them scans a whole collection """
+    finds = [
+        ("users", {'username': "username"}),
+        ("stories", {'_id': ObjectId(), 'user_id': ObjectId()}),
+        ("story_segments", {'story_id': ObjectId()}),
+        ("story_openings", {'world_key': "key"}),
+        ("story_worlds", {'_id': "key"})
+    ]
+
+    failures = 0
+    for collection, query in finds:
+        scans = find_collection_scans(mongo.db[collection].find(query).explain())
+        failures += bool(scans)
+        click.echo(f"{'COLLSCAN' if scans else 'ok':8} {collection}.find({query})")
+
+    if failures:
+        click.echo(f"{failures} queries scan a whole collection")
+        raise SystemExit(1)
+
+
+def record_parse(generator, response):
+    """ Count whether the generated text for a generator parsed into a story with options """
+    metrics.increment(f"story_parses_{generator.name}")
+    if len(response['options']) == 0:
+        metrics.increment(f"story_parse_failures_{generator.name}")
+
+
+class StoryMetrics(Resource):
+    """ StoryMetrics resource to report story generation counters """
+
+    @staticmethod
+    def get():
+        """ Handle GET request to fetch the story generation counters """
+        counters = metrics.snapshot()
+
+        # Share of generations that parsed, for each generator
+        parse_success_rates = {}
+        for name in (local_generator.name, gradient_generator.name):
+            parses = counters.get(f"story_parses_{name}", 0)
+            if parses:
+                parse_success_rates[name] = 1 - counters.get(f"story_parse_failures_{name}", 0) / parses
+
+        return {"counters": counters, "parse_success_rates": parse_success_rates,
+                "grammar": app.config["LLAMA_USE_GRAMMAR"], "attempt_p95_seconds": story_hedger.p95()}, 200
 
 
 # Add resources to API
 api.add_resource(Register, '/register')
 api.add_resource(Login, '/login')
 api.add_resource(Story, '/story')
+api.add_resource(Stories, '/stories')
+api.add_resource(StorySession, '/stories/<story_id>')
+api.add_resource(StoryMetrics, '/metrics')
+
+ensure_indexes()
+
+metrics = Metrics()
+
+# Initialise the pool of llama.cpp servers, whose health is checked in the background
+endpoint_pool = EndpointPool(app.config["LLAMA_ENDPOINTS"], app.config["LLAMA_MAX_IN_FLIGHT"], app.config["LLAMA_TIMEOUT"],
+                             app.config["LLAMA_SLOTS"], app.config["LLAMA_MAX_FAILURES"])
 
 # Initialise the Gradient AI and Local AI generators
-local_generator = LocalAIGenerator()
+local_generator = LocalAIGenerator(endpoint_pool)
 gradient_generator = GradientAIGenerator()
+story_hedger = StoryHedger(ThreadPoolExecutor(max_workers=app.config["STORY_WORKERS"], thread_name_prefix="story"),
+                           app.config["STORY_HEDGE_DEPTH"], app.config["STORY_HEDGE_ON_P95"],
+                           app.config["STORY_MAX_ATTEMPTS"], app.config["STORY_DEADLINE"])
+story_compactor = StoryCompactor(ThreadPoolExecutor(max_workers=app.config["STORY_SUMMARY_WORKERS"],
+                                                    thread_name_prefix="summary"),
+                                 app.config["STORY_CONTEXT_TOKENS"], app.config["STORY_RECENT_PARAGRAPHS"],
+                                 app.config["STORY_SUMMARY_CACHE_SIZE"])
+opening_pool = OpeningPool(ThreadPoolExecutor(max_workers=app.config["STORY_OPENING_WORKERS"],
+                                              thread_name_prefix="opening"),
+                           [local_generator, gradient_generator], app.config["STORY_OPENING_DEPTH"],
+                           app.config["STORY_OPENING_WORLDS"], timedelta(hours=app.config["STORY_OPENING_TTL_HOURS"]))
+
+
+def start_background_work():
+    """
+    Start checking the health of the llama.cpp servers and filling the opening pool in the background. Called by the
+    servers (serve.py, or running app.py directly) rather than on import, so CLI commands such as audit-indexes don't
+    start generating openings alongside them
+    """
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(endpoint_pool.check_health, 'interval', seconds=app.config["LLAMA_HEALTH_INTERVAL"],
+                      next_run_time=datetime.now(), max_instances=1, coalesce=True)
+    scheduler.add_job(opening_pool.fill, 'interval', minutes=1, max_instances=1, coalesce=True)
+    scheduler.start()
+
+
+if __name__ == "__main__":
+    start_background_work()
+    app.run()
@@ -0,0 +1,102 @@
+"""
+Password hashing on a small dedicated pool of threads, so a burst of sign ins can't occupy every request worker.
+
+Hashes wait for a thread in a bounded queue, and once it is full PasswordHasher refuses more with HasherBusy so the
+request can be answered with 503 straight away. When served with gevent (see serve.py) the hashing runs on gevent's pool
+of real threads instead, as hashing in a greenlet would stop every other request until it finished.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    monkey = None
+
+
+class HasherBusy(Exception):
+    """ Raised when too many passwords are waiting to be hashed """
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords with Flask-Bcrypt on a bounded pool of threads
+    """
+
+    def __init__(self, flask_bcrypt, rounds, workers, max_queue):
+        """ Initialise PasswordHasher, with the bcrypt cost new hashes are made at """
+        self.flask_bcrypt = flask_bcrypt
+        self.rounds = rounds
+        # Taken by each hash while it runs or waits for a thread
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        if monkey is not None and monkey.is_module_patched("threading"):
+            self.thread_pool = ThreadPool(workers)
+            self.executor = None
+        else:
+            self.thread_pool = None
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+
+    def run(self, function, *args):
+        """ Run a hashing function on the pool and wait for its result, raising HasherBusy if the queue is full """
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy("Too many sign ins at once, please try again shortly")
+        try:
+            if self.thread_pool is not None:
+                return self.thread_pool.apply(function, args)
+            return self.executor.submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        """ Hash a password at the current cost """
+        return self.run(self.flask_bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def check(self, hashed_password, password):
+        """ Check a password against its stored hash """
+        return self.run(self.flask_bcrypt.check_password_hash, hashed_password, password)
+
+    def needs_rehash(self, hashed_password):
+        """
+        Whether a stored hash was made at a lower cost than the current one. Costs are only ever raised, so servers
+        tuned to slightly different costs don't keep rehashing each other's hashes
+        """
+        return hash_rounds(hashed_password) < self.rounds
+
+    def upgrade(self, users, user, password):
+        """ Rehash a user's password, once it has been checked, if its stored hash was made at a lower cost """
+        if not self.needs_rehash(user['password']):
+            return
+        try:
+            hashed_password = self.hash(password)
+        except HasherBusy:
+            # The hash is upgraded at a later sign in instead
+            return
+        # Only replace the hash that was checked, in case the password has been changed since
+        users.update_one({'_id': user['_id'], 'password': user['password']}, {'$set': {'password': hashed_password}})
+
+
+def hash_rounds(hashed_password):
+    """ The cost a bcrypt hash was made at, from its "$2b$<cost>$..." prefix """
+    return int(hashed_password.split("$")[2])
+
+
+def tune_rounds(target_ms, minimum=12, maximum=16):
+    """
+    Highest bcrypt cost whose hashes take no longer than target_ms milliseconds on this machine, but never below minimum
+    (by default 12, Flask-Bcrypt's own default) so a slow or busy machine can't weaken the hashes. Timed at a low cost and
+    extrapolated, as each extra round doubles the time
+    """
+    rounds = 8
+    elapsed_ms = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"tune", bcrypt.gensalt(rounds))
+        elapsed_ms = min(elapsed_ms, (time.perf_counter() - start) * 1000)
+    while rounds < maximum and elapsed_ms * 2 <= target_ms:
+        elapsed_ms *= 2
+        rounds += 1
+    return max(rounds, minimum)
@@ -0,0 +1,33 @@
+"""
+Serve the app with gevent, so a request waiting on the model or MongoDB waits cooperatively instead of holding a worker
+thread, and one process can hold hundreds of story requests in flight while /login stays fast:
+
+    python serve.py
+
+The standard library (sockets, threads, locks and queues) is patched before the app is imported, which makes pymongo,
+requests and the Gradient client cooperative without changing the app. SERVE_HOST, SERVE_PORT and
+SERVE_MAX_CONNECTIONS configure the server.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+from dotenv import load_dotenv
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+# Worker threads are greenlets once patched, so the story workers no longer need to be kept to a handful. Set before
+# the app is imported, as it reads its config then
+load_dotenv()
+os.environ.setdefault("STORY_WORKERS", "256")
+
+from app import app, start_background_work
+
+if __name__ == "__main__":
+    start_background_work()
+    host = os.getenv("SERVE_HOST", "0.0.0.0")
+    port = int(os.getenv("SERVE_PORT", 5000))
+    server = WSGIServer((host, port), app, spawn=Pool(int(os.getenv("SERVE_MAX_CONNECTIONS", 1000))))
+    app.logger.info("Serving on %s:%d", host, port)
+    server.serve_forever()
@@ -0,0 +1,200 @@
+"""
+Microbenchmarks for the CPU bound paths of the quiz (Task10.1) and story (Task8.2) backends.
+
+Reports operations per second and the memory allocated per operation (the peak, and how much is still held after it)
+for each path. Results can be saved as a baseline and later runs compared against it:
+
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json
+
+Run from this directory. The backends are imported with the in-memory stand-ins from standins.py, so unless
+--mongo-uri is given the stats benchmarks measure the aggregation against mongomock rather than a real MongoDB.
+"""
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import pymongo
+
+import corpus
+from standins import load_backend
+
+HISTORY_SIZES = [10, 1000, 100000]
+# Largest history the stats are aggregated over with mongomock, which copies every document it reads
+IN_MEMORY_STATS_LIMIT = 10000
+
+
+def measure(operation, min_time, repeat):
+    """ Best operations per second over several rounds of at least min_time seconds, and allocations per operation """
+    # Find how many operations fill a round
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        iterations = max(iterations * 2, int(iterations * min_time / max(elapsed, 1e-9)))
+
+    best = elapsed / iterations
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            operation()
+        best = min(best, (time.perf_counter() - start) / iterations)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    result = operation()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"ops_per_sec": 1 / best, "alloc_peak_bytes": peak - before, "alloc_retained_bytes": current - before}
+
+
+def quiz_benchmarks(quiz_app, sizes, stats_limit):
+    """
+    Benchmarks for the quiz backend, as (name, setup) pairs where setup prepares the data and returns the operation
+    """
+    manager = quiz_app.QuizManager
+    model = quiz_app.quiz_manager.model
+    benchmarks = [
+        ("process_quiz/realistic", lambda: lambda: [manager.process_quiz(text) for text in corpus.QUIZ_REALISTIC]),
+        ("process_quiz/malformed", lambda: lambda: [manager.process_quiz(text) for text in corpus.QUIZ_MALFORMED]),
+        ("prompt/quiz", lambda: lambda: model.quiz_query("Algorithms")),
+    ]
+
+    def history_setup(size, history_type):
+        quizzes = [quiz for quiz in corpus.make_quizzes(size) if quiz['complete']]
+        return lambda: quiz_app.filter_history(quizzes, history_type)
+
+    def stats_setup(size):
+        # Each size gets its own database, so the aggregation only sees that user's quizzes
+        quiz_app.mongo.db = quiz_app.mongo.cx[f"bench_stats_{size}"]
+        quiz_app.mongo.db.quizzes.drop()
+        quiz_app.mongo.db.quizzes.create_index([("user_id", pymongo.ASCENDING)])
+        quizzes = corpus.make_quizzes(size)
+        quiz_app.mongo.db.quizzes.insert_many(quizzes)
+        return lambda: quiz_app.calculate_stats(quizzes[0]['user_id'])
+
+    def stored_stats_setup():
+        quiz_app.mongo.db = quiz_app.mongo.cx["bench_stats"]
+        user_id = corpus.make_quizzes(1)[0]['user_id']
+        quiz_app.mongo.db.stats.replace_one({"_id": user_id}, {"total_questions": 30, "correct_answers": 12,
+                                                               "quizzes_ready": 3}, upsert=True)
+        return lambda: quiz_app.get_stats(user_id)
+
+    for size in sizes:
+        for history_type in ("all", "incorrect"):
+            benchmarks.append((f"filter_history/{history_type}/{size}",
+                               lambda size=size, history_type=history_type: history_setup(size, history_type)))
+        if size <= stats_limit:
+            benchmarks.append((f"calculate_stats/{size}", lambda size=size: stats_setup(size)))
+    benchmarks.append(("get_stats/stored", stored_stats_setup))
+    return benchmarks
+
+
+def story_benchmarks(story_app):
+    """
+    Benchmarks for the story backend, as (name, setup) pairs where setup prepares the data and returns the operation
+    """
+    process = story_app.AbstractGenerator.process_generated_text
+    local = story_app.local_generator
+    gradient = story_app.gradient_generator
+    world = corpus.WORLDS[0]
+    rng = random.Random(305)
+    short_story = corpus.make_story(6, rng)
+    long_story = corpus.make_story(200, rng)
+
+    def compact_setup():
+        # Summarise the story before timing, so compacting it reuses the summary rather than starting a refresh
+        compactor = story_app.story_compactor
+        paragraphs = compactor.split_paragraphs(long_story)
+        key = compactor.story_key(world, paragraphs)
+        compactor.refresh(gradient, key, world, paragraphs[:-compactor.recent_paragraphs], 0, "")
+        return lambda: compactor.compact(gradient, world, long_story)
+
+    return [
+        ("process_generated_text/realistic", lambda: lambda: [process(text) for text in corpus.STORY_REALISTIC]),
+        ("process_generated_text/malformed", lambda: lambda: [process(text) for text in corpus.STORY_MALFORMED]),
+        ("prompt/story_beginning/local", lambda: lambda: local.story_beginning_query(world)),
+        ("prompt/next_part/local", lambda: lambda: local.next_part_query(world, short_story, "Continue...")),
+        ("prompt/compact/long_story", compact_setup),
+    ]
+
+
+def compare(results, baseline, threshold):
+    """ Print the change in ops/sec from the baseline, returning the benchmarks slower by more than the threshold """
+    regressions = []
+    print(f"\n{'benchmark':40} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        change = result['ops_per_sec'] / before - 1
+        print(f"{name:40} {before:12.1f} {result['ops_per_sec']:12.1f} {change:+8.1%}")
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argument_parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=HISTORY_SIZES,
+                                 help="numbers of quizzes in the synthetic histories")
+    argument_parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per timing round")
+    argument_parser.add_argument("--repeat", type=int, default=3, help="timing rounds per benchmark, the best is kept")
+    argument_parser.add_argument("--save", help="save the results as JSON to this path")
+    argument_parser.add_argument("--compare", help="compare the results with a baseline saved with --save")
+    argument_parser.add_argument("--threshold", type=float, default=0.1,
+                                 help="slowdown from the baseline reported as a regression, as a fraction")
+    argument_parser.add_argument("--mongo-uri", help="run the stats benchmarks against this MongoDB instead, for "
+                                                     f"histories over {IN_MEMORY_STATS_LIMIT} quizzes too")
+    args = argument_parser.parse_args()
+
+    quiz_app = load_backend("Task10.1")
+    stats_limit = IN_MEMORY_STATS_LIMIT
+    if args.mongo_uri:
+        quiz_app.mongo.cx = pymongo.MongoClient(args.mongo_uri)
+        stats_limit = max(args.sizes)
+    story_app = load_backend("Task8.2")
+    # Logging rejected model output would otherwise dominate the parsing benchmarks
+    quiz_app.app.logger.setLevel(logging.WARNING)
+    story_app.app.logger.setLevel(logging.WARNING)
+    benchmarks = quiz_benchmarks(quiz_app, args.sizes, stats_limit) + story_benchmarks(story_app)
+
+    results = {}
+    print(f"{'benchmark':40} {'ops/sec':>12} {'peak KB/op':>11} {'held KB/op':>11}")
+    for name, setup in benchmarks:
+        if args.filter not in name:
+            continue
+        result = measure(setup(), args.min_time, args.repeat)
+        results[name] = result
+        print(f"{name:40} {result['ops_per_sec']:12.1f} {result['alloc_peak_bytes'] / 1024:11.1f} "
+              f"{result['alloc_retained_bytes'] / 1024:11.1f}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                       "created": datetime.now().isoformat(), "results": results}, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks are more than {args.threshold:.0%} slower: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
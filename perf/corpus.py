@@ -0,0 +1,180 @@
+"""
+Fixed corpus of model outputs and synthetic data for the benchmarks and the load test.
+
+The realistic outputs follow the formats the prompts ask for, including the chatter models add around them. The
+malformed outputs are the failures seen in practice: truncation, missing or out of order markers, answers that aren't
+a letter, and runaway repetition.
+"""
+import random
+
+from bson.objectid import ObjectId
+
+TOPICS = ["Algorithms", "Data Structures", "Databases", "Networking", "Operating Systems", "Security"]
+
+WORLDS = [
+    {"genre": "Fantasy", "subgenre": "High fantasy", "premise": "A young mage discovers a forbidden spell."},
+    {"genre": "Science fiction", "subgenre": "Space opera", "premise": "A cargo pilot finds a stowaway android."},
+    {"genre": "Mystery", "subgenre": "Noir", "premise": "A detective wakes up with no memory of the last night."},
+]
+
+QUIZ_REALISTIC = [
+    (
+        "QUESTION: What is the time complexity of binary search on a sorted array?\n"
+        "OPTION A: O(n)\n"
+        "OPTION B: O(log n)\n"
+        "OPTION C: O(n log n)\n"
+        "OPTION D: O(1)\n"
+        "ANS: B\n"
+        "QUESTION: Which data structure uses first in, first out ordering?\n"
+        "OPTION A: Stack\n"
+        "OPTION B: Tree\n"
+        "OPTION C: Queue\n"
+        "OPTION D: Graph\n"
+        "ANS: C\n"
+        "QUESTION: Which sorting algorithm has the best worst case time complexity?\n"
+        "OPTION A: Merge sort\n"
+        "OPTION B: Quick sort\n"
+        "OPTION C: Bubble sort\n"
+        "OPTION D: Insertion sort\n"
+        "ANS: A\n"
+    ),
+    (
+        "Sure! Here is a quiz on Databases:\n\n"
+        "QUESTION: What does the C in ACID stand for?\n"
+        "OPTION A: Concurrency\n"
+        "OPTION B: Consistency\n"
+        "OPTION C: Caching\n"
+        "OPTION D: Commit\n"
+        "ANS: B\n\n"
+        "QUESTION: Which SQL clause filters groups: WHERE or HAVING?\n"
+        "OPTION A: WHERE\n"
+        "OPTION B: GROUP BY\n"
+        "OPTION C: HAVING\n"
+        "OPTION D: ORDER BY\n"
+        "ANS: C) HAVING\n\n"
+        "QUESTION: What kind of index does a B-tree provide?\n"
+        "OPTION A: Hash only\n"
+        "OPTION B: Ordered\n"
+        "OPTION C: Bitmap\n"
+        "OPTION D: Spatial\n"
+        "ANS: B\n\n"
+        "I hope this helps!"
+    ),
+]
+
+QUIZ_MALFORMED = [
+    # Truncated in the middle of the second question
+    QUIZ_REALISTIC[0][:260],
+    # Options out of order and a missing option
+    (
+        "QUESTION: Which layer of the OSI model routes packets?\n"
+        "OPTION A: Physical\n"
+        "OPTION C: Transport\n"
+        "OPTION B: Network\n"
+        "ANS: B\n"
+        "QUESTION: Which protocol is connectionless?\n"
+        "OPTION A: TCP\n"
+        "OPTION B: UDP\n"
+        "OPTION C: HTTP\n"
+        "ANS: B\n"
+    ),
+    # Answers written out instead of as a letter
+    (
+        "QUESTION: What does a mutex protect?\n"
+        "OPTION A: A critical section\n"
+        "OPTION B: The disk\n"
+        "OPTION C: The network\n"
+        "OPTION D: The cache\n"
+        "ANS: A critical section\n"
+    ),
+    # Runaway repetition of one option, which the old pattern backtracked on
+    "QUESTION: Which of these is a prime number?\n" + "OPTION A: 4\n" * 60,
+    # No markers at all
+    "I'm sorry, but I can't generate a quiz on that topic. " * 10,
+]
+
+STORY_REALISTIC = [
+    (
+        "STORY: The lantern flickered as the cellar door creaked open.\n\n"
+        "Cold air carried the smell of salt and old rope: the sea was close, closer than the map had promised.\n\n"
+        "Somewhere below, something heavy shifted in the dark.\n"
+        "OPTION_A: Continue...\n"
+        "OPTION_B: Call out to whoever is down there\n"
+        "OPTION_C: Close the door and bar it\n"
+    ),
+    (
+        "Here is the next part of the story:\n\n"
+        "STORY: The android's eyes opened slowly, its optics adjusting to the dim light of the cargo bay.\n\n"
+        "\"Where are we going?\" it asked, as if it had every right to be there.\n"
+        "OPTION_A: Tell it the truth\n"
+        "OPTION_B: Lie: say you're headed to a scrapyard\n"
+    ),
+]
+
+STORY_MALFORMED = [
+    # Truncated before the options
+    STORY_REALISTIC[0][:150],
+    # Options without the story marker, out of order
+    "The rain kept falling.\nOPTION_B: Run\nOPTION_A: Hide\n",
+    # Repeated markers from a model stuck in a loop
+    "STORY: " + "OPTION_A: again " * 80,
+    # Refusal
+    "I cannot continue this story. " * 10,
+]
+
+SUMMARY = ("The player, a young mage, found a forbidden spell in the academy archives and fled the city with it, "
+           "pursued by the archmage's hounds. They are hiding in a smugglers' cellar near the sea.")
+
+REASONING = "The correct answer describes the defining property, while the selected answer describes a different one."
+
+
+def reply(query):
+    """ Reply to a prompt with realistic output in the format it asks for """
+    if "Generate a quiz" in query:
+        return QUIZ_REALISTIC[len(query) % len(QUIZ_REALISTIC)]
+    if "INCORRECT ANSWER" in query:
+        return REASONING
+    if "Summarise the story" in query:
+        return SUMMARY
+    return STORY_REALISTIC[len(query) % len(STORY_REALISTIC)]
+
+
+def malformed_reply(query):
+    """ Reply to a prompt with malformed output """
+    if "Generate a quiz" in query:
+        return QUIZ_MALFORMED[len(query) % len(QUIZ_MALFORMED)]
+    if "INCORRECT ANSWER" in query or "Summarise the story" in query:
+        return ""
+    return STORY_MALFORMED[len(query) % len(STORY_MALFORMED)]
+
+
+def make_story(paragraphs, rng):
+    """ A story of the given number of paragraphs, as sent back by the client """
+    sentences = [sentence for text in STORY_REALISTIC for sentence in text.split("\n")
+                 if sentence and not sentence.startswith("OPTION_")]
+    return "\n\n".join(rng.choice(sentences).replace("STORY: ", "") for _ in range(paragraphs))
+
+
+def make_quizzes(count, user_id=None, complete_ratio=0.9, seed=305):
+    """ Synthetic quizzes for a user, like those the app stores, most of them completed """
+    rng = random.Random(seed)
+    user_id = user_id or ObjectId()
+    quizzes = []
+    for index in range(count):
+        questions = [{
+            "question": f"Question {index}.{number} about {rng.choice(TOPICS)}?",
+            "options": [f"Option {letter}" for letter in "ABCD"],
+            "correct_answer": rng.choice("ABCD")
+        } for number in range(3)]
+        complete = rng.random() < complete_ratio
+        selected_answers = [rng.choice("ABCD") for _ in questions] if complete else []
+        quizzes.append({
+            "_id": ObjectId(),
+            "user_id": user_id,
+            "complete": complete,
+            "selected_answers": selected_answers,
+            "topic": rng.choice(TOPICS),
+            "questions": questions,
+            "score": sum(q['correct_answer'] == a for q, a in zip(questions, selected_answers))
+        })
+    return quizzes
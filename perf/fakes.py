@@ -0,0 +1,141 @@
+"""
+Fake model backends for the load test, with configurable latency and rates of malformed output.
+
+FakeLlamaServer serves the llama.cpp /completion (plain and streamed) and /health endpoints over HTTP. fake_reply builds
+the reply function used by standins.FakeGradient, as the Gradient client is replaced in process.
+"""
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import corpus
+
+
+class LatencyModel:
+    """
+    Log-normal latency, described by its median and the spread (sigma) of its logarithm, which gives the long tail
+    model servers have
+    """
+
+    def __init__(self, median, sigma, seed=None):
+        """ Initialise LatencyModel, with the median in seconds """
+        self.median = median
+        self.sigma = sigma
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        """ Draw a latency in seconds """
+        with self.lock:
+            return self.median * math.exp(self.sigma * self.rng.gauss(0, 1))
+
+
+class OutputModel:
+    """ Chooses realistic or malformed output for a prompt, at a given malformed rate """
+
+    def __init__(self, malformed_rate, seed=None):
+        """ Initialise OutputModel """
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def reply(self, prompt):
+        """ Output for a prompt """
+        with self.lock:
+            malformed = self.rng.random() < self.malformed_rate
+        return corpus.malformed_reply(prompt) if malformed else corpus.reply(prompt)
+
+
+def fake_reply(latency, output):
+    """ Reply function for FakeGradient, which waits for a sampled latency before replying """
+    def reply(query):
+        time.sleep(latency.sample())
+        return output.reply(query)
+    return reply
+
+
+class FakeLlamaHandler(BaseHTTPRequestHandler):
+    """ Request handler for FakeLlamaServer """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/completion":
+            self.send_json(404, {"error": "not found"})
+            return
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        content = self.server.output.reply(body.get("prompt", ""))
+        latency = self.server.latency.sample()
+        self.server.count()
+
+        if not body.get("stream"):
+            time.sleep(latency)
+            self.send_json(200, {"content": content, "stop": True})
+            return
+
+        # Stream the content in small pieces, spread over the latency as tokens would be
+        pieces = [content[index:index + 8] for index in range(0, len(content), 8)] or [""]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for piece in pieces:
+                time.sleep(latency / len(pieces))
+                self.wfile.write(f"data: {json.dumps({'content': piece, 'stop': False})}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(f"data: {json.dumps({'content': '', 'stop': True})}\n\n".encode("utf-8"))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early, e.g. to cancel a losing hedged attempt, so stop generating as
+            # llama.cpp does
+            pass
+
+
+class FakeLlamaServer(ThreadingHTTPServer):
+    """ Fake llama.cpp server on a free local port, serving requests on daemon threads """
+
+    daemon_threads = True
+    # Accept bursts of connections as a real server would, rather than refusing them past the default backlog of 5
+    request_queue_size = 1024
+
+    def __init__(self, latency, output):
+        """ Initialise FakeLlamaServer """
+        super().__init__(("127.0.0.1", 0), FakeLlamaHandler)
+        self.latency = latency
+        self.output = output
+        self.completions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self):
+        with self.lock:
+            self.completions += 1
+
+    def start(self):
+        """ Serve requests in a background thread """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
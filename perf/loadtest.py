@@ -0,0 +1,308 @@
+"""
+End-to-end load test of the quiz (Task10.1) and story (Task8.2) backends, with local stand-ins for everything else.
+
+Each backend's app.py is served over HTTP from this process, against mongomock (or a real MongoDB with --mongo-uri).
+Gradient is replaced by a fake client and the llama.cpp servers by fake HTTP servers, both with log-normal latency and
+a rate of malformed output. Virtual users then drive a mix of traffic like the apps send, and the latency percentiles
+and throughput of each endpoint are reported, e.g.:
+
+    python loadtest.py --users 40 --duration 60 --llama-latency-ms 800 --malformed-rate 0.1
+
+Run from this directory.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import requests
+from bson.objectid import ObjectId
+from werkzeug.serving import make_server
+
+import corpus
+from fakes import FakeLlamaServer, LatencyModel, OutputModel, fake_reply
+from standins import FakeGradient, load_backend
+
+
+class Recorder:
+    """ Records the latency and outcome of every request, by endpoint """
+
+    def __init__(self):
+        """ Initialise Recorder """
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    @staticmethod
+    def percentile(latencies, fraction):
+        """ Nearest rank percentile of sorted latencies """
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+    def report(self, elapsed):
+        """ Summary of each endpoint: requests, errors, throughput and latency percentiles in milliseconds """
+        rows = {}
+        with self.lock:
+            for endpoint, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                rows[endpoint] = {
+                    "requests": len(latencies),
+                    "errors": self.errors[endpoint],
+                    "throughput": len(latencies) / elapsed,
+                    "p50_ms": self.percentile(latencies, 0.50) * 1000,
+                    "p95_ms": self.percentile(latencies, 0.95) * 1000,
+                    "p99_ms": self.percentile(latencies, 0.99) * 1000,
+                    "max_ms": latencies[-1] * 1000
+                }
+        return rows
+
+
+class Client:
+    """ HTTP client for one virtual user, recording each request under the endpoint it exercises """
+
+    def __init__(self, base_url, recorder, timeout):
+        """ Initialise Client """
+        self.base_url = base_url
+        self.recorder = recorder
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, method, endpoint, path, **kwargs):
+        """ Make a request and read the whole response, returning it or None if it failed to connect """
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            response.content
+        except requests.RequestException:
+            self.recorder.record(endpoint, time.perf_counter() - start, False)
+            return None
+        self.recorder.record(endpoint, time.perf_counter() - start, response.status_code < 400)
+        return response
+
+    def register(self):
+        """ Register a new user and use its token for every request after, returning the user id or None """
+        name = uuid.uuid4().hex
+        response = self.request("POST", "POST /register", "/register", json={
+            "username": name, "password": name, "email": f"{name}@example.com", "phone_number": "0400000000"})
+        if response is None or response.status_code != 201:
+            return None
+        self.session.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+        return response.json()['user']['id']
+
+
+def think(rng, stop, mean):
+    """ Wait for an exponentially distributed think time, returning False once the test is stopping """
+    return not stop.wait(rng.expovariate(1 / mean) if mean > 0 else 0)
+
+
+def quiz_user(client, rng, stop, args, quiz_app):
+    """ A user of the quiz app: sets their interests, then takes quizzes and looks at their history and stats """
+    user_id = client.register()
+    if user_id is None:
+        return
+    # Start with a history of quizzes, as generating them needs the sweep
+    quiz_app.mongo.db.quizzes.insert_many(corpus.make_quizzes(args.history, ObjectId(user_id), 0.8, rng.random()))
+    client.request("PUT", "PUT /userinterests", "/userinterests",
+                   json={"interests": rng.sample(quiz_app.INTERESTS, 3)})
+
+    actions = ["quizzes", "submit", "history_all", "history_incorrect", "stats", "profile", "interests"]
+    weights = [30, 15, 10, 10, 15, 10, 10]
+    incomplete = []
+    while think(rng, stop, args.think_time):
+        action = rng.choices(actions, weights)[0]
+        if action == "quizzes":
+            response = client.request("GET", "GET /quizzes", "/quizzes?complete=false&limit=5")
+            if response is not None and response.status_code == 200:
+                incomplete = [quiz['quiz_id'] for quiz in response.json()['quizzes']]
+        elif action == "submit" and incomplete:
+            client.request("PUT", "PUT /quizzes", "/quizzes", json={
+                "quiz_id": incomplete.pop(), "selected_answers": [rng.choice("ABCD") for _ in range(3)]})
+        elif action == "history_all":
+            client.request("GET", "GET /history/<type>", "/history/all")
+        elif action == "history_incorrect":
+            client.request("GET", "GET /history/<type>", "/history/incorrect")
+        elif action == "stats":
+            client.request("GET", "GET /stats", "/stats")
+        elif action == "profile":
+            client.request("GET", "GET /sharedprofile/<id>", f"/sharedprofile/{user_id}")
+        elif action == "interests":
+            client.request("PUT", "PUT /userinterests", "/userinterests",
+                           json={"interests": rng.sample(quiz_app.INTERESTS, 3)})
+
+
+def story_result(response, stream):
+    """ The story and options from a story response, or None if it failed """
+    if response is None or response.status_code >= 400:
+        return None
+    if not stream:
+        return response.json()
+    for line in reversed(response.text.splitlines()):
+        if line.startswith("{"):
+            event = json.loads(line)
+            return event if event['event'] == "done" else None
+    return None
+
+
+def story_user(client, rng, stop, args, story_app):
+    """ A user of the story app: plays stories of a few turns, through /story or a story session """
+    if client.register() is None:
+        return
+    while think(rng, stop, args.think_time):
+        world = rng.choice(corpus.WORLDS)
+        use_local_llm = rng.random() < args.local_share
+        stream = rng.random() < args.stream_share
+        query = "?stream=ndjson" if stream else ""
+        suffix = " (stream)" if stream else ""
+        turns = rng.randint(2, 5)
+
+        if rng.random() < args.session_share:
+            result = story_result(client.request("POST", f"POST /stories{suffix}", f"/stories{query}", json={
+                "world": world, "use_local_llm": use_local_llm}), stream)
+            for _ in range(turns):
+                if result is None or not think(rng, stop, args.think_time):
+                    break
+                result = story_result(client.request(
+                    "POST", f"POST /stories/<id>{suffix}", f"/stories/{result['story_id']}{query}",
+                    json={"user_selection": rng.choice(result['options'])}), stream)
+            continue
+
+        story = ""
+        result = story_result(client.request("POST", f"POST /story opening{suffix}", f"/story{query}", json={
+            "story": "", "world": world, "user_selection": "", "use_local_llm": use_local_llm}), stream)
+        for _ in range(turns):
+            if result is None or not think(rng, stop, args.think_time):
+                break
+            story = f"{story}\n\n{result['story']}" if story else result['story']
+            result = story_result(client.request("POST", f"POST /story next{suffix}", f"/story{query}", json={
+                "story": story, "world": world, "user_selection": rng.choice(result['options']),
+                "use_local_llm": use_local_llm}), stream)
+
+
+def sweep(recorder, stop, interval, quiz_app):
+    """ Run the quiz generation sweep every interval seconds, recording how long it takes """
+    while not stop.wait(interval):
+        start = time.perf_counter()
+        try:
+            quiz_app.quiz_manager.generate_quizzes()
+            ok = True
+        except Exception as e:
+            logging.getLogger(__name__).warning("Quiz generation sweep failed: %s", e)
+            ok = False
+        recorder.record("sweep generate_quizzes", time.perf_counter() - start, ok)
+
+
+def serve(module):
+    """ Serve a backend's Flask app on a free local port in a background thread, returning its base URL """
+    server = make_server("127.0.0.1", 0, module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def print_report(rows, elapsed):
+    print(f"\n{'endpoint':34} {'requests':>8} {'errors':>6} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8}")
+    for endpoint, row in rows.items():
+        print(f"{endpoint:34} {row['requests']:8} {row['errors']:6} {row['throughput']:7.2f} {row['p50_ms']:8.1f} "
+              f"{row['p95_ms']:8.1f} {row['p99_ms']:8.1f} {row['max_ms']:8.1f}")
+    total = sum(row['requests'] for row in rows.values())
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argument_parser.add_argument("--backend", choices=["quiz", "story", "all"], default="all")
+    argument_parser.add_argument("--users", type=int, default=20, help="virtual users, split between the backends")
+    argument_parser.add_argument("--duration", type=float, default=60, help="seconds of traffic after ramp up")
+    argument_parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which users start")
+    argument_parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds between a user's requests")
+    argument_parser.add_argument("--gradient-latency-ms", type=float, default=1500, help="median Gradient latency")
+    argument_parser.add_argument("--llama-latency-ms", type=float, default=800, help="median llama.cpp latency")
+    argument_parser.add_argument("--latency-sigma", type=float, default=0.6,
+                                 help="spread of the log-normal model latency, larger gives a longer tail")
+    argument_parser.add_argument("--malformed-rate", type=float, default=0.05, help="fraction of malformed outputs")
+    argument_parser.add_argument("--llama-servers", type=int, default=2, help="fake llama.cpp servers")
+    argument_parser.add_argument("--quiz-model", choices=["gradient", "local", "fake"], default="gradient",
+                                 help="model the quiz backend generates with, local uses the fake llama.cpp servers")
+    argument_parser.add_argument("--history", type=int, default=30, help="quizzes each quiz user starts with")
+    argument_parser.add_argument("--local-share", type=float, default=0.7, help="fraction of stories using llama.cpp")
+    argument_parser.add_argument("--stream-share", type=float, default=0.3, help="fraction of stories streamed")
+    argument_parser.add_argument("--session-share", type=float, default=0.5,
+                                 help="fraction of stories played as story sessions rather than through /story")
+    argument_parser.add_argument("--sweep-interval", type=float, default=30,
+                                 help="seconds between quiz generation sweeps, 0 to not run them")
+    argument_parser.add_argument("--timeout", type=float, default=180, help="client timeout in seconds")
+    argument_parser.add_argument("--mongo-uri", help="use this MongoDB instead of mongomock")
+    argument_parser.add_argument("--seed", type=int, default=305)
+    argument_parser.add_argument("--json", help="also write the report as JSON to this path")
+    args = argument_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # The request log would otherwise be printed for every request
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    recorder = Recorder()
+    stop = threading.Event()
+
+    # Fake model backends, which must exist before the apps are loaded as their config is read on import
+    FakeGradient.reply = staticmethod(fake_reply(LatencyModel(args.gradient_latency_ms / 1000, args.latency_sigma,
+                                                              args.seed),
+                                                 OutputModel(args.malformed_rate, args.seed)))
+    llama_servers = [FakeLlamaServer(LatencyModel(args.llama_latency_ms / 1000, args.latency_sigma, args.seed + index),
+                                     OutputModel(args.malformed_rate, args.seed + index)).start()
+                     for index in range(args.llama_servers)]
+    os.environ["LLAMA_ENDPOINTS"] = ",".join(server.url for server in llama_servers)
+    os.environ["QUIZ_MODEL"] = args.quiz_model
+
+    users = []
+    if args.backend in ("quiz", "all"):
+        quiz_app = load_backend("Task10.1", start_background=True, mongo_uri=args.mongo_uri)
+        quiz_app.app.logger.setLevel(logging.WARNING)
+        quiz_url = serve(quiz_app)
+        users.append((quiz_user, quiz_url, quiz_app))
+        if args.sweep_interval > 0:
+            threading.Thread(target=sweep, args=(recorder, stop, args.sweep_interval, quiz_app), daemon=True).start()
+    if args.backend in ("story", "all"):
+        story_app = load_backend("Task8.2", start_background=True, mongo_uri=args.mongo_uri)
+        story_app.app.logger.setLevel(logging.WARNING)
+        story_url = serve(story_app)
+        users.append((story_user, story_url, story_app))
+
+    threads = []
+    for index in range(args.users):
+        user, url, module = users[index % len(users)]
+        client = Client(url, recorder, args.timeout)
+        rng = random.Random(args.seed * 1000 + index)
+        threads.append(threading.Thread(target=user, args=(client, rng, stop, args, module), daemon=True))
+
+    print(f"Starting {args.users} users over {args.ramp_up}s, then running for {args.duration}s")
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+        time.sleep(args.ramp_up / max(len(threads), 1))
+    stop.wait(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(args.timeout)
+    elapsed = time.perf_counter() - start
+
+    rows = recorder.report(elapsed)
+    print_report(rows, elapsed)
+    completions = sum(server.completions for server in llama_servers)
+    print(f"{completions} llama.cpp completions across {len(llama_servers)} fake servers")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"args": vars(args), "elapsed": elapsed, "endpoints": rows}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
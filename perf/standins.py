@@ -0,0 +1,89 @@
+"""
+In-memory stand-ins for MongoDB and Gradient, so the backends can be imported and run without either.
+
+load_backend imports a backend's app.py with flask_pymongo backed by mongomock and gradientai.Gradient replaced by
+FakeGradient, whose replies come from the corpus.
+"""
+import importlib.util
+import os
+import sys
+
+import flask_pymongo
+import gradientai
+import mongomock
+
+import corpus
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REAL_PYMONGO = flask_pymongo.PyMongo
+
+
+class FakeCompletion:
+    """ Stand-in for a Gradient completion response """
+
+    def __init__(self, generated_output):
+        self.generated_output = generated_output
+
+
+class FakeModelAdapter:
+    """ Stand-in for a Gradient model adapter, replying to each prompt with FakeGradient.reply """
+
+    def complete(self, query, max_generated_token_count):
+        return FakeCompletion(FakeGradient.reply(query))
+
+
+class FakeBaseModel:
+    """ Stand-in for a Gradient base model """
+
+    def create_model_adapter(self, name):
+        return FakeModelAdapter()
+
+
+class FakeGradient:
+    """ Stand-in for gradientai.Gradient """
+
+    # Function from a prompt to the generated text, replaced to add latency or malformed output
+    reply = staticmethod(corpus.reply)
+
+    def __init__(self, **kwargs):
+        pass
+
+    def get_base_model(self, base_model_slug):
+        return FakeBaseModel()
+
+
+class InMemoryPyMongo:
+    """ Stand-in for flask_pymongo.PyMongo, backed by a mongomock client """
+
+    def __init__(self, app=None, uri=None, *args, **kwargs):
+        self.cx = mongomock.MongoClient()
+        self.db = self.cx["app"]
+
+
+def load_backend(task, start_background=False, mongo_uri=None):
+    """
+    Import a backend's app.py (e.g. load_backend("Task10.1")) with the stand-ins, as a module named after the task so
+    several backends can be loaded at once. Its background work (generation and scheduled jobs) is only started if
+    asked for, as the servers do, and a real MongoDB is used instead of mongomock if its URI is given
+    """
+    backend = os.path.join(ROOT, task, "backend")
+    os.environ.setdefault("JWT_SECRET_KEY", "perf-secret-key-that-is-long-enough")
+    os.environ["MONGO_URI"] = mongo_uri or "mongodb://localhost:27017/app"
+
+    gradientai.Gradient = FakeGradient
+    flask_pymongo.PyMongo = REAL_PYMONGO if mongo_uri else InMemoryPyMongo
+
+    # Each backend has its own copy of its sibling modules, so drop any copy loaded for another backend
+    sys.modules.pop("parsing", None)
+    sys.path.insert(0, backend)
+    name = "app_" + task.replace(".", "_").lower()
+    spec = importlib.util.spec_from_file_location(name, os.path.join(backend, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(backend)
+    if start_background:
+        module.start_background_work()
+    return module